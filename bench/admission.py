@@ -0,0 +1,72 @@
+# Benchmark `ping` latency while other clients spam a heavy command,
+# with and without a `max_concurrency` limit on the heavy command
+#
+# Usage: python bench/admission.py [pings] [spammers]
+
+import sys
+import time
+import threading
+
+import oi
+
+
+def run_program(address, max_concurrency):
+    """ Start a program in the background and return it """
+    program = oi.Program('bench', address, service_workers=4)
+    program.add_command(
+        'heavy', lambda: time.sleep(0.05) or 'done',
+        max_concurrency=max_concurrency)
+    for w in program.workers:
+        w.daemon = True
+        w.start()
+    return program
+
+
+def measure(address, pings, spammers):
+    """ Return ping latencies in ms, sorted, while `spammers` threads
+    call `heavy` back to back """
+
+    done = threading.Event()
+
+    def spam():
+        client = oi.ClientWrapper(address, 10000)
+        while not done.is_set():
+            client.call('heavy')
+        client.close()
+
+    threads = [threading.Thread(target=spam) for _ in range(spammers)]
+    [t.start() for t in threads]
+    time.sleep(0.2)
+
+    client, latencies = oi.ClientWrapper(address, 10000), []
+    for _ in range(pings):
+        start = time.time()
+        client.call('ping')
+        latencies.append((time.time() - start) * 1000)
+        time.sleep(0.01)
+    client.close()
+
+    done.set()
+    [t.join() for t in threads]
+    return sorted(latencies)
+
+
+def main():
+    pings = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    spammers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    print('{} pings, {} clients spamming a 50ms command, 4 workers'.format(
+        pings, spammers))
+
+    for limit in (None, 2):
+        address = 'ipc:///tmp/oi-bench-admission-{}.sock'.format(limit)
+        run_program(address, limit)
+        time.sleep(0.1)
+        latencies = measure(address, pings, spammers)
+        print('max_concurrency={:<5} ping p50 {:>7.2f}ms  p99 {:>7.2f}ms'.format(
+            str(limit), latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)]))
+
+
+if __name__ == '__main__':
+    main()
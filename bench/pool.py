@@ -0,0 +1,60 @@
+# Benchmark Program throughput against the number of service workers
+# when command handlers block on I/O
+#
+# Usage: python bench/pool.py [requests] [clients]
+
+import sys
+import time
+import threading
+
+import oi
+
+
+def run_program(address, service_workers, delay):
+    """ Start a program in the background and return it """
+    program = oi.Program('bench', address, service_workers=service_workers)
+    program.add_command('io', lambda: time.sleep(delay) or 'done')
+    for w in program.workers:
+        w.daemon = True
+        w.start()
+    return program
+
+
+def hammer(address, requests, clients):
+    """ Issue `requests` calls spread across `clients` threads.
+    Return the number of operations per second """
+
+    def work(n):
+        client = oi.ClientWrapper(address, 10000)
+        for _ in range(n):
+            client.call('io')
+        client.close()
+
+    threads = [
+        threading.Thread(target=work, args=(requests // clients,))
+        for _ in range(clients)]
+
+    start = time.time()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return requests / (time.time() - start)
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    delay = 0.01
+
+    print('{} requests, {} clients, {}ms blocking handler'.format(
+        requests, clients, int(delay * 1000)))
+
+    for n in (1, 2, 4, 8, 16):
+        address = 'ipc:///tmp/oi-bench-pool-{}.sock'.format(n)
+        run_program(address, n, delay)
+        time.sleep(0.1)
+        print('service_workers={:<3} {:>8.1f} ops/sec'.format(
+            n, hammer(address, requests, clients)))
+
+
+if __name__ == '__main__':
+    main()
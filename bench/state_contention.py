@@ -0,0 +1,64 @@
+# Measure State write contention across threads
+#
+# Compares a single module-wide lock (how State used to work) with
+# a lock per State and with a striped State holding many hot keys
+#
+# Usage: python bench/state_contention.py [threads] [writes]
+
+import sys
+import time
+import threading
+
+import oi
+
+
+class GlobalLockState(dict):
+    """ State as it used to be: one lock shared by every instance """
+
+    lock = threading.Lock()
+
+    def __setattr__(self, key, value):
+        with self.lock:
+            self[key] = value
+
+
+def measure(states, threads, writes, keys):
+    """ Each thread writes to its own state (or a shared one) and
+    returns the number of writes per second """
+
+    def work(state, n):
+        for i in range(writes):
+            setattr(state, keys[(n + i) % len(keys)], i)
+
+    pool = [
+        threading.Thread(target=work, args=(states[n % len(states)], n))
+        for n in range(threads)]
+
+    start = time.time()
+    [t.start() for t in pool]
+    [t.join() for t in pool]
+    return threads * writes / (time.time() - start)
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    writes = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    keys = ['key{}'.format(i) for i in range(64)]
+
+    cases = [
+        ('global lock, state per thread',
+         [GlobalLockState() for _ in range(threads)]),
+        ('own lock, state per thread',
+         [oi.State() for _ in range(threads)]),
+        ('own lock, shared state', [oi.State()]),
+        ('striped, shared state', [oi.StripedState()]),
+    ]
+
+    print('{} threads x {} writes'.format(threads, writes))
+    for name, states in cases:
+        print('{:<32} {:>12.0f} writes/sec'.format(
+            name, measure(states, threads, writes, keys)))
+
+
+if __name__ == '__main__':
+    main()
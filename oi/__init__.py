@@ -1,3 +1,4 @@
 from .core import *
+from .durable import *
 from .version import *
 from .worker import *
@@ -0,0 +1,59 @@
+# Admission control
+#
+# A program refuses work it can't take on right away with a "busy"
+# error instead of letting requests pile up: a command called more
+# often than its `max_concurrency` at once, or a pool whose queue
+# already holds `max_queue` jobs. Nothing ran, so clients may safely
+# retry busy calls after backing off.
+
+import time
+import random
+
+BUSY = 'busy'
+
+
+class Busy(Exception):
+    """ A request refused by admission control """
+
+    def __init__(self, reason):
+        super(Busy, self).__init__('{}: {}'.format(BUSY, reason))
+
+
+def is_busy(err):
+    """ Is `err` the error of a refused request """
+    return isinstance(err, str) and err.startswith(BUSY + ':')
+
+
+class RetryPolicy(object):
+    """ Retry busy calls up to `retries` times, waiting `backoff`
+    seconds before the first retry and doubling that up to
+    `max_backoff`. With `jitter` each wait is randomized between half
+    and all of it, so clients turned away together don't come back
+    together """
+
+    def __init__(self, retries=3, backoff=0.05, max_backoff=1.0, jitter=True):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delays(self):
+        delay = self.backoff
+        for _ in range(self.retries):
+            yield delay * random.uniform(0.5, 1) if self.jitter else delay
+            delay = min(delay * 2, self.max_backoff)
+
+    def call(self, function, budget=None):
+        """ Call `function`, returning (res, err), until it is not busy,
+        retries run out or the next wait would overrun `budget` seconds """
+
+        start = time.time()
+        res, err = function()
+        for delay in self.delays():
+            if not is_busy(err):
+                break
+            if budget is not None and time.time() - start + delay > budget:
+                break
+            time.sleep(delay)
+            res, err = function()
+        return res, err
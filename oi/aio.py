@@ -0,0 +1,216 @@
+# asyncio flavoured ctl clients (Python 3.5+)
+#
+# Instead of blocking a thread per request, sockets are used in
+# nonblocking mode and the event loop watches nanomsg's notification
+# descriptors. A REQ socket carries one request at a time, so each
+# address keeps a pool of idle sockets which grows with the number
+# of requests in flight.
+
+import errno
+import asyncio
+
+import nanomsg
+
+from .rpc import Client
+from .core import ClientWrapper
+from .core import CtlProgram
+from .core import Response
+from . import stream
+
+# Python 3.7+; get_event_loop is the running loop inside coroutines before
+get_running_loop = getattr(
+    asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncClientWrapper(ClientWrapper):
+    """ An asyncio counterpart of `ClientWrapper`. `call` and `call_many`
+    are coroutines; timeouts and cancellation follow asyncio semantics """
+
+    def __init__(self, address, timeout=3000, codec='msgpack'):
+        self.timeout = timeout
+        self.codec = codec
+        self.addrs = [a.strip() for a in address.split(',')]
+        self.multi = ',' in address
+        self.idle = dict((a, []) for a in self.addrs)
+
+    def _acquire(self, addr):
+        """ Get an idle client for `addr` or make a new one """
+        idle = self.idle[addr]
+        return idle.pop() if idle else Client(addr, self.timeout, self.codec)
+
+    @staticmethod
+    async def _wait(fd):
+        """ Wait until nanomsg signals `fd`. Both the send and the recv
+        descriptors signal by becoming readable """
+        loop = get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            if not future.done():
+                future.set_result(None)
+
+        loop.add_reader(fd, wake)
+        try:
+            await future
+        finally:
+            loop.remove_reader(fd)
+
+    async def _nonblocking(self, operation, fd):
+        """ Retry a nonblocking socket operation until it goes through """
+        while True:
+            try:
+                return operation()
+            except nanomsg.NanoMsgAPIError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            await self._wait(fd)
+
+    async def _request(self, addr, command, args):
+        """ Send a request to `addr` and wait for the reply """
+
+        client = self._acquire(addr)
+        sock, done = client.socket, False
+        try:
+            payload = client.build_payload(command, args)
+            data = client.sign(client.encode(payload))
+            await self._nonblocking(
+                lambda: sock.send(data, nanomsg.DONTWAIT), sock.send_fd)
+            data = await self._nonblocking(
+                lambda: sock.recv(flags=nanomsg.DONTWAIT), sock.recv_fd)
+            res = client.decode(client.verify(data))
+            client.check_reply(payload, res)
+            done = True
+        finally:
+            # A socket abandoned mid-request can't be reused
+            if done:
+                self.idle[addr].append(client)
+            else:
+                sock.close()
+        return res['result'], res['error']
+
+    async def _call_single(self, addr, command, *args):
+        """ Call single """
+        try:
+            return await asyncio.wait_for(
+                self._request(addr, command, args), self.timeout / 1000.0)
+        except asyncio.TimeoutError:
+            return None, 'timeout'
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return None, str(e)
+
+    async def _drain(self, addr, res, err):
+        """ Collect every item of a streamed reply """
+        if err or not stream.is_stream(res):
+            return res, err
+        items = []
+        while True:
+            items.extend(res['items'])
+            if not res['more']:
+                return items, None
+            res, err = await self._call_single(
+                addr, 'stream_next', res[stream.MARKER])
+            if err:
+                return None, err
+
+    async def _call_drained(self, addr, command, *args):
+        res, err = await self._call_single(addr, command, *args)
+        return await self._drain(addr, res, err)
+
+    async def _call_multi(self, addrs, command, *args):
+        """ Call every address concurrently """
+        replies = await asyncio.gather(
+            *[self._call_drained(a, command, *args) for a in addrs])
+        responses = dict((a, r[0]) for a, r in zip(addrs, replies))
+        errors = dict((a, r[1]) for a, r in zip(addrs, replies))
+        return responses, errors
+
+    async def call(self, command, *args):
+        """ Call remote service(s) """
+        if self.multi:
+            return await self._call_multi(self.addrs, command, *args)
+        return await self._call_drained(self.addrs[0], command, *args)
+
+    async def call_many(self, calls):
+        """ Send a batch of (command, args) calls in a single round-trip.
+        See `ClientWrapper.call_many` """
+        calls = [[command, list(args)] for command, args in calls]
+        replies, errors = await self.call('batch', *calls)
+        return self._unpack_many(len(calls), replies, errors)
+
+    def is_multi(self):
+        """ Does this object include multiple clients """
+        return self.multi
+
+    def close(self):
+        """ Close idle socket(s) """
+        for idle in self.idle.values():
+            for client in idle:
+                client.socket.close()
+            del idle[:]
+
+
+class AsyncCtlProgram(CtlProgram):
+    """ A CtlProgram whose `call` and `call_many` are coroutines, for
+    embedding control calls in asyncio services. Local commands still
+    run synchronously """
+
+    def __init__(self, description, address, timeout=3000,
+                 publish_address=None, codec='msgpack'):
+        super(AsyncCtlProgram, self).__init__(
+            description, None, timeout, publish_address, codec=codec)
+        self.address = address
+        self.client = AsyncClientWrapper(
+            address, timeout, codec) if address else None
+        self.event_loop = None
+
+    async def call(self, command, *args):
+        """ Execute local OR remote command and return its response """
+
+        if not command:
+            return
+
+        if command in self.registered:
+            return super(AsyncCtlProgram, self).call(command, *args)
+
+        res, err = await self.client.call(command, *args)
+        multi = self.client.is_broadcast(command, *args)
+        return Response('remote', res, err, multi)
+
+    async def call_many(self, calls):
+        """ Execute a list of (command, args) and return their responses.
+        Consecutive remote commands are sent together in one batch """
+
+        responses, pending = [], []
+
+        async def flush():
+            if not pending:
+                return
+            replies = await self.client.call_many(pending)
+            for (command, args), (res, err) in zip(pending, replies):
+                multi = self.client.is_broadcast(command, *args)
+                responses.append(Response('remote', res, err, multi))
+            del pending[:]
+
+        for command, args in calls:
+            if command in self.registered:
+                await flush()
+                responses.append(await self.call(command, *args))
+            else:
+                pending.append((command, args))
+        await flush()
+        return responses
+
+    def execute(self, calls):
+        """ Drive `call`/`call_many` from the synchronous ctl loop """
+
+        async def run():
+            if len(calls) > 1:
+                return await self.call_many(calls)
+            command, args = calls[0]
+            return [await self.call(command, *args)]
+
+        if self.event_loop is None:
+            self.event_loop = asyncio.new_event_loop()
+        return self.event_loop.run_until_complete(run())
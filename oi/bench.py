@@ -0,0 +1,258 @@
+# Round-trip benchmark, run with `oi bench [option=value ...]`
+#
+# Options (comma separated lists):
+#
+#   transports=ipc,tcp,inproc   transports to measure; `direct` calls
+#                               the program in-process, without sockets
+#   sizes=16,1024,1048576       payload sizes in bytes
+#   clients=1,4,16              numbers of concurrent clients
+#   requests=2000               requests per run, spread across clients
+#   workers=1                   service workers of the benchmarked program
+#   codecs=msgpack              wire codecs (msgpack, json, pickle)
+#   payload=str                 payload type, str or bytes
+#   json=path                   also write the results as JSON to path
+#
+# Besides round-trips, each row reports how fast the codec alone
+# encodes and decodes the reply, in MB/s.
+
+import os
+import sys
+import json
+import time
+import socket
+import uuid
+import platform
+import threading
+
+from . import core
+from . import codec
+from . import compat
+from . import version
+
+DEFAULTS = {
+    'transports': 'ipc,tcp,inproc',
+    'sizes': '16,1024,65536,1048576',
+    'clients': '1,4,16',
+    'requests': '2000',
+    'workers': '1',
+    'codecs': 'msgpack',
+    'payload': 'str',
+    'json': '',
+}
+
+
+def free_port():
+    """ Ask the OS for a free tcp port on localhost """
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def new_address(transport):
+    """ A fresh address for `transport` """
+    name = 'oi-bench-{}-{}'.format(os.getpid(), int(time.time() * 1000))
+    if transport == 'ipc':
+        return 'ipc:///tmp/{}.sock'.format(name)
+    if transport == 'tcp':
+        return 'tcp://127.0.0.1:{}'.format(free_port())
+    if transport in ('inproc', 'direct'):
+        return 'inproc://{}'.format(name)
+    raise ValueError('Unknown transport `{}`'.format(transport))
+
+
+def unlimit(sock):
+    """ Let `sock` receive messages of any size. nanomsg drops those
+    over 1MiB by default, and the largest payloads are that big """
+    import nanomsg
+    sock.set_int_option(nanomsg.SOL_SOCKET, nanomsg.RCVMAXSIZE, -1)
+
+
+def start_program(address, workers):
+    """ Run a program with an echo command in background threads """
+    program = core.Program(
+        'bench', address, service_workers=workers,
+        codecs=list(codec.CODECS))
+    program.add_command('echo', lambda payload: payload)
+    for service in program.services:
+        unlimit(service.socket)
+    for sock in program.sockets:
+        unlimit(sock)
+    for w in program.workers:
+        w.daemon = True
+        w.start()
+    return program
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def make_payload(kind, size):
+    return b'x' * size if kind == 'bytes' else 'x' * size
+
+
+def codec_speed(name, payload, seconds=0.2):
+    """ Encode and decode an echo reply with codec `name` for about
+    `seconds` each. Return (encode MB/s, decode MB/s) """
+
+    c = codec.get(name)
+    reply = {'result': payload, 'error': None, 'ref': str(uuid.uuid4())}
+    size = len(c.encode(reply))
+
+    def rate(operation):
+        count, start = 0, compat.perf_counter()
+        while True:
+            for _ in range(10):
+                operation()
+            count += 10
+            elapsed = compat.perf_counter() - start
+            if elapsed >= seconds:
+                return round(count * size / elapsed / 1e6, 1)
+
+    message = c.encode(reply)
+    body = memoryview(message)[len(c.tag):]
+    return rate(lambda: c.encode(reply)), rate(lambda: c.decode(body))
+
+
+def measure(address, size, clients, requests, codec='msgpack',
+            payload='str', direct=False):
+    """ Make `requests` echo calls with a `size` bytes payload from
+    `clients` threads, calling the program directly if `direct`.
+    Return ops/sec and latency percentiles in ms """
+
+    payload = make_payload(payload, size)
+    latencies, errors = [], []
+    per_client = max(1, requests // clients)
+
+    def work():
+        if direct:
+            client = core.DirectClientWrapper(
+                core.local_program(address), 30000)
+        else:
+            client = core.ClientWrapper(address, 30000, codec=codec)
+            unlimit(client.c.socket)
+        mine = []
+        for _ in range(per_client):
+            start = compat.perf_counter()
+            res, err = client.call('echo', payload)
+            mine.append((compat.perf_counter() - start) * 1000)
+            if err:
+                errors.append(err)
+        client.close()
+        latencies.extend(mine)
+
+    threads = [threading.Thread(target=work) for _ in range(clients)]
+    start = compat.perf_counter()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    elapsed = compat.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'ops_per_sec': round(len(latencies) / elapsed, 1),
+        'errors': len(errors),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def run(transports, sizes, clients, requests, workers=1, codecs=('msgpack',),
+        payload='str'):
+    """ Benchmark every combination. Return a list of result dicts """
+
+    speeds = dict(
+        ((name, size), codec_speed(name, make_payload(payload, size)))
+        for name in codecs for size in sizes)
+
+    results = []
+    for transport in transports:
+        address = new_address(transport)
+        program = start_program(address, workers)
+        time.sleep(0.1)  # let the service bind
+        for name in codecs:
+            for size in sizes:
+                for n in clients:
+                    result = {
+                        'transport': transport, 'codec': name,
+                        'payload': payload, 'size': size, 'clients': n,
+                        'requests': requests, 'workers': workers,
+                    }
+                    result['encode_mbps'], result['decode_mbps'] = \
+                        speeds[name, size]
+                    result.update(measure(
+                        address, size, n, requests, name, payload,
+                        transport == 'direct'))
+                    results.append(result)
+        program.close()
+    return results
+
+
+def to_text(results):
+    """ A table with a row per result; latencies in ms """
+
+    def fmt(value):
+        return '{:.3f}'.format(value) if isinstance(value, float) else str(value)
+
+    keys = ('transport', 'codec', 'size', 'clients', 'ops_per_sec',
+            'p50', 'p95', 'p99', 'errors', 'encode_mbps', 'decode_mbps')
+    rows = [keys] + [tuple(fmt(r[k]) for k in keys) for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(keys))]
+    return '\n'.join(
+        '  '.join(col.rjust(w) for col, w in zip(row, widths))
+        for row in rows)
+
+
+def parse_options(args):
+    """ Turn ['key=value', ...] into options, filling in defaults """
+
+    options = dict(DEFAULTS)
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep or key not in DEFAULTS:
+            raise ValueError('Unknown option `{}`; options are {}'.format(
+                arg, ', '.join(sorted(DEFAULTS))))
+        options[key] = value
+
+    def ints(value):
+        return [int(v) for v in value.split(',') if v.strip()]
+
+    if options['payload'] not in ('str', 'bytes'):
+        raise ValueError('payload must be str or bytes')
+    codecs = [c.strip() for c in options['codecs'].split(',')]
+    for name in codecs:
+        codec.get(name)
+
+    return {
+        'transports': [t.strip() for t in options['transports'].split(',')],
+        'codecs': codecs,
+        'payload': options['payload'],
+        'sizes': ints(options['sizes']),
+        'clients': ints(options['clients']),
+        'requests': int(options['requests']),
+        'workers': int(options['workers']),
+        'json': options['json'],
+    }
+
+
+def bench(program, *args):
+    """ Entry point of `oi bench` """
+
+    options = parse_options(list(args))
+    path = options.pop('json')
+    results = run(**options)
+
+    if path:
+        with open(path, 'w') as fh:
+            json.dump({
+                'oi': version.VERSION,
+                'python': platform.python_version(),
+                'platform': sys.platform,
+                'results': results,
+            }, fh, indent=2, sort_keys=True)
+
+    return to_text(results)
@@ -0,0 +1,104 @@
+# Result caching and sharing for idempotent commands
+
+import time
+import threading
+import collections
+
+from . import context
+
+
+class TTLCache(object):
+    """ A thread safe LRU cache whose entries expire `ttl` seconds
+    after they were stored """
+
+    def __init__(self, ttl, max_entries=128):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(args):
+        """ Arguments may arrive as (unhashable) lists, so key on their
+        representation """
+        return repr(args)
+
+    def get(self, args):
+        """ Return (True, value) on a hit and (False, None) on a miss """
+        key = self.key(args)
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return False, None
+            if expires < time.time():
+                return False, None
+            self.entries[key] = (expires, value)  # most recently used
+            return True, value
+
+    def put(self, args, value):
+        key = self.key(args)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Flight(object):
+    """ A call in progress, and its outcome once it lands """
+
+    def __init__(self):
+        self.landed = threading.Event()
+        self.value = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """ Concurrent calls with the same arguments share one execution:
+    the first runs, the others wait for its result or exception. Unlike
+    `TTLCache` nothing is kept once the call returns """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, args, function):
+        """ Return (shared, value): the value of `function()`, or of the
+        identical call already running, in which case `shared` is True.
+        Waiting callers give up when their own deadline passes """
+
+        key = TTLCache.key(args)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            if not flight.landed.wait(context.remaining()):
+                raise context.DeadlineExceeded('deadline exceeded')
+            if flight.exception is not None:
+                raise flight.exception
+            return True, flight.value
+
+        try:
+            flight.value = function()
+            return False, flight.value
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.landed.set()
+
+    def __len__(self):
+        return len(self.flights)
@@ -0,0 +1,241 @@
+# Wire codecs
+#
+# Every message starts with a byte naming its codec, except msgpack
+# messages which go untagged, as they always did:
+#
+#   msgpack  <msgpack>                  bytes travel as msgpack bin
+#   json     J<json>                    bytes travel base64 encoded
+#   pickle   P<n:u32><len:u64 x n><pickle protocol 5><n buffers>
+#
+# Pickled memoryviews (and PickleBuffers) travel out-of-band after the
+# pickle and come back as read-only memoryviews over the received
+# message, without being copied. Unpickling runs arbitrary code, so
+# programs only accept pickle when told to.
+#
+# A service decodes each request with the codec it came in and
+# replies with the same one, so clients pick their codec per message.
+#
+# A message of at least `threshold` bytes may also be compressed, if
+# that makes it smaller. The compressed message is tagged in turn:
+#
+#   zlib     Z<zlib compressed message>
+#   lz4      L<lz4 frame>               when the lz4 package is installed
+#
+# A small compressed message can expand to gigabytes, so decoding
+# gives up past `max_size` bytes.
+
+import io
+import json
+import zlib
+import struct
+import base64
+import pickle
+
+import msgpack
+
+from . import compat
+
+COUNT = struct.Struct('<I')
+LENGTH = struct.Struct('<Q')
+
+
+class CodecError(Exception):
+    """ A message in a codec which is unknown or not accepted """
+
+
+# Each codec's `encode` returns the whole message, tag included, and
+# `decode` takes it without the tag
+
+class MsgPack(object):
+    name, tag = 'msgpack', b''
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class Json(object):
+    name, tag = 'json', b'J'
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+        raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+    @staticmethod
+    def _hook(obj):
+        if len(obj) == 1 and '__bytes__' in obj:
+            return base64.b64decode(obj['__bytes__'])
+        return obj
+
+    def encode(self, data):
+        return self.tag + json.dumps(
+            data, separators=(',', ':'), default=self._default).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(
+            bytes(data).decode('utf-8'), object_hook=self._hook)
+
+
+if hasattr(pickle, 'PickleBuffer'):
+
+    class _Pickler(pickle.Pickler):
+        """ Send memoryviews out-of-band instead of failing on them """
+
+        def reducer_override(self, obj):
+            if type(obj) is memoryview:
+                return memoryview, (pickle.PickleBuffer(obj),)
+            return NotImplemented
+
+
+class Pickle(object):
+    """ pickle protocol 5 with out-of-band buffers (Python 3.8+) """
+
+    name, tag = 'pickle', b'P'
+
+    def encode(self, data):
+        buffers, body = [], io.BytesIO()
+        _Pickler(body, protocol=5, buffer_callback=buffers.append).dump(data)
+        views = [b.raw() for b in buffers]
+        return b''.join(
+            [self.tag, COUNT.pack(len(views))] +
+            [LENGTH.pack(v.nbytes) for v in views] +
+            [body.getvalue()] + views)
+
+    def decode(self, data):
+        view = memoryview(data)
+        count, = COUNT.unpack_from(view, 0)
+        offset = COUNT.size
+        lengths = []
+        for _ in range(count):
+            lengths.append(LENGTH.unpack_from(view, offset)[0])
+            offset += LENGTH.size
+        end = len(view) - sum(lengths)
+        buffers = []
+        start = end
+        for length in lengths:
+            buffers.append(view[start:start + length])
+            start += length
+        return pickle.loads(view[offset:end], buffers=buffers)
+
+
+class Compressor(object):
+    """ `decompress(data, limit)` returns at most `limit` bytes """
+
+    def __init__(self, name, tag, compress, decompress):
+        self.name, self.tag = name, tag
+        self.compress, self.decompress = compress, decompress
+
+
+def _zlib_decompress(data, limit):
+    return zlib.decompressobj().decompress(data, limit)
+
+
+COMPRESSORS = {'zlib': Compressor(
+    'zlib', b'Z', lambda data: zlib.compress(data, 1), _zlib_decompress)}
+try:
+    import lz4.frame
+
+    def _lz4_decompress(data, limit):
+        return lz4.frame.LZ4FrameDecompressor().decompress(data, limit)
+
+    COMPRESSORS['lz4'] = Compressor(
+        'lz4', b'L', lz4.frame.compress, _lz4_decompress)
+except ImportError:
+    pass
+COMPRESSED_BY_TAG = dict((c.tag, c) for c in COMPRESSORS.values())
+
+# Smaller messages aren't worth the CPU
+THRESHOLD = 64 * 1024
+
+# Larger decompressed messages are refused
+MAX_SIZE = 256 * 1024 * 1024
+
+CODECS = dict((c.name, c) for c in (MsgPack(), Json()))
+if hasattr(pickle, 'PickleBuffer'):
+    CODECS['pickle'] = Pickle()
+BY_TAG = dict((c.tag, c) for c in CODECS.values() if c.tag)
+
+
+def get(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown codec `{}`; codecs are {}'.format(
+            name, ', '.join(sorted(CODECS))))
+
+
+def compressor(name):
+    """ The compressor called `name`, or None for no compression """
+    if name is None:
+        return None
+    try:
+        return COMPRESSORS[name]
+    except KeyError:
+        raise ValueError('Unknown or unavailable compression `{}`; '
+                         'available are {}'.format(
+                             name, ', '.join(sorted(COMPRESSORS))))
+
+
+class WireEncoder(object):
+    """ A nanoservice encoder. Encodes with `codec`, or with the codec
+    of the last message decoded when `reply_in_kind`, and decodes
+    messages in any of the `accept`ed codecs.
+
+    Messages of `threshold` bytes or more are compressed with
+    `compress`, if set. Compressed messages are always accepted, up to
+    `max_size` bytes decompressed. Sizes and time spent go to `stats`,
+    a `metrics.CompressionStats` """
+
+    def __init__(self, codec='msgpack', accept=None, reply_in_kind=False,
+                 compress=None, threshold=THRESHOLD, stats=None,
+                 max_size=MAX_SIZE):
+        self.codec = get(codec)
+        self.accept = set(accept or (codec, 'msgpack'))
+        for name in self.accept:
+            get(name)
+        self.reply_in_kind = reply_in_kind
+        self.last = self.codec
+        self.compress = compressor(compress)
+        self.threshold = threshold
+        self.stats = stats
+        self.max_size = max_size
+
+    def encode(self, data):
+        codec = self.last if self.reply_in_kind else self.codec
+        message = codec.encode(data)
+        if self.compress is None or len(message) < self.threshold:
+            return message
+
+        start = compat.perf_counter()
+        compressed = self.compress.tag + self.compress.compress(message)
+        if self.stats is not None:
+            self.stats.compressed(
+                len(message), len(compressed),
+                (compat.perf_counter() - start) * 1000)
+        return compressed if len(compressed) < len(message) else message
+
+    def decode(self, data):
+        compressed = COMPRESSED_BY_TAG.get(data[:1])
+        if compressed is not None:
+            start, size = compat.perf_counter(), len(data)
+            data = compressed.decompress(
+                memoryview(data)[1:], self.max_size + 1)
+            if len(data) > self.max_size:
+                raise CodecError('{} message is over {} bytes'.format(
+                    compressed.name, self.max_size))
+            if self.stats is not None:
+                self.stats.decompressed(
+                    len(data), size, (compat.perf_counter() - start) * 1000)
+
+        codec = BY_TAG.get(data[:1], CODECS['msgpack'])
+        self.last = CODECS['msgpack']
+        if codec.name not in self.accept:
+            raise CodecError('codec `{}` is not accepted'.format(codec.name))
+        self.last = codec
+        if codec.tag:
+            data = memoryview(data)[len(codec.tag):]
+        return codec.decode(data)
@@ -7,3 +7,20 @@ try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+try:
+    from os import cpu_count
+except ImportError:
+    def cpu_count():
+        import multiprocessing
+        return multiprocessing.cpu_count()
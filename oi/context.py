@@ -0,0 +1,53 @@
+# Per-request context
+#
+# The service thread answering a request notes its deadline here, so
+# the program can shed it once it expired and handlers can check how
+# much time their caller still waits.
+
+import time
+import threading
+import contextlib
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """ The caller of a request stopped waiting for it """
+
+
+def deadline():
+    """ The absolute deadline (time.time() based) of the request being
+    handled by this thread, or None """
+    return getattr(_local, 'deadline', None)
+
+
+def remaining():
+    """ Seconds left until the deadline of the current request, or None
+    if it has no deadline. May be negative """
+    d = deadline()
+    return None if d is None else d - time.time()
+
+
+def expired():
+    d = deadline()
+    return d is not None and time.time() >= d
+
+
+@contextlib.contextmanager
+def request(deadline):
+    """ Run the body as handling a request with `deadline` """
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def call(function, deadline, *args):
+    """ Run `function` under `deadline`, in a pool thread or process,
+    unless the deadline passed while the job was queued """
+    if deadline is not None and time.time() >= deadline:
+        raise DeadlineExceeded('deadline exceeded')
+    with request(deadline):
+        return function(*args)
@@ -1,37 +1,250 @@
 import sys
+import time
 import argparse
+import functools
+import contextlib
+import collections
 import threading
-import readline
 import logging
-
-from colorama import Fore
-from nanoservice import Service
-from nanoservice import Client
+import uuid
+import weakref
 
 from . import version
 from . import worker
 from . import compat
 from . import util
+from . import cache
+from . import metrics
+from . import stream
+from . import events
+from . import health
+from . import context
+from . import admission
+from . import tracing
+
+# Programs of this process by address, for ctls to call directly
+_programs = weakref.WeakValueDictionary()
+
 
-lock = threading.Lock()
+def local_program(address):
+    """ The Program of this process serving `address`, if any """
+    return _programs.get(address)
 
 
 class State(dict):
-    """ A dot access dictionary """
+    """ A dot access dictionary.
+
+    Every state owns its lock(s). Writes through items, attributes or
+    bulk methods are exclusive, single key reads are lock-free (a dict
+    lookup is atomic) and whole-state reads such as `snapshot` share
+    the lock with other readers.
+
+    Every mutation is passed to `_changed`, while the write lock is
+    still held, and from there to listeners added with `subscribe`.
+
+    Mutations also bump a version and note the keys they changed in a
+    log of the last `changelog_size` changes, so `changes_since` can
+    answer with only what changed since an earlier version. Versions
+    restart with every state, so each state also has a random `epoch`
+    telling them apart """
+
+    stripes = 1
+    changelog_size = 10000
 
     def __init__(self, *args, **kwargs):
-        super(State, self).__init__(self, *args, **kwargs)
+        locks = [util.RWLock() for _ in range(self.stripes)]
+        object.__setattr__(self, '_locks', locks)
+        object.__setattr__(self, '_listeners', [])
+        object.__setattr__(self, '_version', [0])
+        object.__setattr__(
+            self, '_changelog', collections.deque(maxlen=self.changelog_size))
+        object.__setattr__(self, '_changelog_lock', threading.Lock())
+        # Versions up to this one may have been dropped from the log
+        object.__setattr__(self, '_evicted', [0])
+        object.__setattr__(self, 'epoch', uuid.uuid4().hex)
+        super(State, self).__init__(*args, **kwargs)
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    def _stripe(self, key):
+        """ The lock guarding `key` """
+        locks = self._locks
+        return locks[hash(key) % len(locks)] if len(locks) > 1 else locks[0]
+
+    def _changed(self, op, *args):
+        """ Called after each mutation with one of:
+        ('set', key, value), ('del', key), ('update', items), ('clear',) """
+
+        with self._changelog_lock:
+            self._version[0] += 1
+            version = self._version[0]
+            if op == 'set' or op == 'del':
+                entries = [(version, args[0])]
+            elif op == 'update':
+                entries = [(version, key) for key in args[0]]
+            else:
+                # A clear can't be told as a list of keys
+                entries = [(version, None)]
+
+            log = self._changelog
+            overflow = len(log) + len(entries) - log.maxlen
+            if overflow > 0:
+                self._evicted[0] = (
+                    log[overflow - 1][0] if overflow <= len(log) else version)
+            log.extend(entries)
+
+        for listener in self._listeners:
+            listener(op, *args)
+
+    def subscribe(self, listener):
+        """ Call `listener(op, *args)` after every mutation, as `_changed`
+        gets them. Listeners run under the write lock, so keep them
+        quick and don't write to the state from them """
+        self._listeners.append(listener)
+
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        """ Lock every stripe, for bulk operations """
+        for lock in self._locks:
+            if shared:
+                lock.acquire_read()
+            else:
+                lock.acquire_write()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._locks):
+                if shared:
+                    lock.release_read()
+                else:
+                    lock.release_write()
 
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
-            raise AttributeError
+            raise AttributeError(key)
 
     def __setattr__(self, key, value):
-        lock.acquire()
         self[key] = value
-        lock.release()
+
+    def __delattr__(self, key):
+        try:
+            del self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setitem__(self, key, value):
+        lock = self._stripe(key)
+        lock.acquire_write()
+        try:
+            super(State, self).__setitem__(key, value)
+            self._changed('set', key, value)
+        finally:
+            lock.release_write()
+
+    def __delitem__(self, key):
+        lock = self._stripe(key)
+        lock.acquire_write()
+        try:
+            super(State, self).__delitem__(key)
+            self._changed('del', key)
+        finally:
+            lock.release_write()
+
+    def pop(self, key, *default):
+        lock = self._stripe(key)
+        lock.acquire_write()
+        try:
+            found = key in self
+            value = super(State, self).pop(key, *default)
+            if found:
+                self._changed('del', key)
+            return value
+        finally:
+            lock.release_write()
+
+    def setdefault(self, key, default=None):
+        lock = self._stripe(key)
+        lock.acquire_write()
+        try:
+            if key not in self:
+                super(State, self).__setitem__(key, default)
+                self._changed('set', key, default)
+            return self[key]
+        finally:
+            lock.release_write()
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        with self._locked():
+            super(State, self).update(items)
+            self._changed('update', items)
+
+    def __ior__(self, other):
+        # `state |= other` (Python 3.9+) would bypass update otherwise
+        self.update(other)
+        return self
+
+    def popitem(self):
+        with self._locked():
+            key, value = super(State, self).popitem()
+            self._changed('del', key)
+            return key, value
+
+    def clear(self):
+        with self._locked():
+            super(State, self).clear()
+            self._changed('clear')
+
+    def changes_since(self, version, epoch=None):
+        """ Return what changed after `version` as a dict with the current
+        `version` and `epoch`, `changed` items and `deleted` keys. If the
+        change log doesn't reach back that far, or `version` belongs to
+        another `epoch` (e.g. before the program restarted), `full` is
+        True and `changed` holds the whole state """
+
+        with self._changelog_lock:
+            current = self._version[0]
+            evicted = self._evicted[0]
+            log = list(self._changelog)
+
+        reply = {'version': current, 'epoch': self.epoch, 'full': False,
+                 'changed': {}, 'deleted': []}
+        stale = version > current or (
+            epoch is not None and epoch != self.epoch)
+        if version == current and not stale:
+            return reply
+
+        keys = set(key for v, key in log if v > version)
+        if stale or version < evicted or None in keys:
+            reply['full'] = True
+            reply['changed'] = self.snapshot()
+            return reply
+
+        for key in keys:
+            try:
+                reply['changed'][key] = self[key]
+            except KeyError:
+                reply['deleted'].append(key)
+        return reply
+
+    def snapshot(self):
+        """ Return a consistent plain dict copy of the state """
+        with self._locked(shared=True):
+            return dict(self)
+
+    def copy(self):
+        return self.__class__(self.snapshot())
+
+
+class StripedState(State):
+    """ A state whose keys are spread over several locks, so writers of
+    different hot keys don't wait on each other. Bulk operations still
+    take every stripe """
+
+    stripes = 16
 
 
 class BaseProgram(object):
@@ -41,7 +254,7 @@ class BaseProgram(object):
         self.description = description
         self.address = address
         self.parser = self.new_parser()
-        self.state = state or State()
+        self.state = state if state is not None else State()
         self.workers = workers or []
         self.registered = {}  # registered commands
 
@@ -88,42 +301,396 @@ class Program(BaseProgram):
     """ Long running program with a nanoservice endpoint.
 
     `service` - nanoservice Service object
-    `config` - the configuration parsed from --config <filepath> """
-
-    def __init__(self, description, address):
-        super(Program, self).__init__(description, address)
-
-        self.service = Service(address) if address else None
+    `services` - all service objects (more than one in pool mode)
+    `config` - the configuration parsed from --config <filepath>
+    `state` - a `State`, or e.g. a `DurableState` to survive restarts
+
+    With `service_workers` greater than 1, ctl commands are handed out
+    to that many service worker threads, so independent commands run
+    in parallel and a slow command no longer blocks the others.
+
+    Commands returning an iterator (e.g. a generator) have their results
+    streamed to the ctl in chunks of `stream_chunk` items.
+
+    Commands registered with an `executor` run in a thread pool of
+    `thread_pool_size` or a process pool of `process_pool_size` workers
+    (the number of CPUs by default), shared by all such commands.
+
+    With a `publish_address`, state changes and events sent with
+    `publish` go out on a second socket, for ctls to `watch`.
+
+    With `max_queue`, at most that many jobs wait for a free worker of
+    each pool; further requests for pooled commands get a busy error
+    (see `admission`), as do calls beyond a command's `max_concurrency`.
+
+    With `profiling`, the `profile` and `memtop` commands inspect the
+    running program; see `profiler`.
+
+    Requests are timed by `tracer`, by default a `tracing.Tracer`
+    keeping the last 1000 in memory, and the `trace` command shows
+    the slowest of them.
+
+    Requests may come in any of `codecs` (see `codec`) and are answered
+    in the same one. Only add 'pickle' when everyone able to connect
+    is trusted """
+
+    def __init__(self, description, address, service_workers=1, state=None,
+                 stream_chunk=1000, thread_pool_size=4, process_pool_size=None,
+                 publish_address=None, max_queue=None, profiling=False,
+                 tracer=None, codecs=('msgpack', 'json')):
+        super(Program, self).__init__(description, address, state)
+        self.metrics = metrics.Metrics()
+        self.streams = stream.Streams(stream_chunk)
+        self.pool_sizes = {
+            'thread': thread_pool_size,
+            'process': process_pool_size or compat.cpu_count() or 1}
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        self.pool_jobs = {'thread': 0, 'process': 0}
+        self.max_queue = max_queue
+
+        self.publisher = None
+        if publish_address:
+            self.publisher = events.Publisher(publish_address)
+            self.state.subscribe(self.publisher.state_changed)
+
+        self.tracer = tracer if tracer is not None else tracing.Tracer()
+        self.codecs = codecs
+        if address:
+            _programs[address] = self
+        self.sockets = []
+        self.services = self.new_services(
+            address, service_workers) if address else []
+        self.service = self.services[0] if self.services else None
+        for service in self.services:
+            service.tracer = self.tracer
         self.config = compat.configparser.ConfigParser()
 
         # Add the flag for parsing configuration file
         self.parser.add_argument(
             '--config', help='configuration file to use', nargs='?')
 
-        if self.service is None:
-            return
-
-        # Add default service worker, which will respond to ctl commands
+        # Add default service worker(s), which will respond to ctl commands
         # Other workers will perform other kind of work, such as
         # fetching resources from the web, etc
-        self.workers.append(worker.ServiceWorker(self.service))
+        for service in self.services:
+            self.workers.append(worker.ServiceWorker(service))
 
         # Add default commands
         self.add_command('ping', lambda: 'pong')
         self.add_command('help', self.help_function)
+        self.add_command(
+            'batch', self.batch_function, 'run several commands at once')
+        self.add_command(
+            'stats', self.stats_function,
+            'show call metrics per command; `stats json` for scraping')
+        self.add_command(
+            'state_since', lambda version, epoch=None:
+            self.state.changes_since(int(version), epoch),
+            'state keys changed since a version (and epoch); '
+            '`state_since 0` for all')
+        self.add_command(
+            'stream_next', self.streams.next, 'next chunk of a streamed reply')
+        self.add_command(
+            'stream_close', self.streams.close, 'drop a streamed reply')
+        self.add_command(
+            'trace', lambda n=10: self.tracer.to_text(int(n)),
+            'slowest recent requests and where their time went, in ms')
+
+        self.profiler = self.memory = None
+        if profiling:
+            from . import profiler
+            self.profiler = profiler.Profiler()
+            self.memory = profiler.MemoryTracker()
+            self.add_command(
+                'profile', self.profile_function,
+                'sample all threads: `profile start [interval ms]`, '
+                '`profile top [n]`, `profile stop`')
+            self.add_command(
+                'memtop', self.memtop_function,
+                'lines allocating the most since the last `memtop [n]`; '
+                '`memtop stop` to stop tracing')
+
+    def new_services(self, address, count):
+        """ Create the service(s) responding on `address`.
+
+        In pool mode a device relays requests from a front socket bound
+        to `address` onto an inproc socket, where `count` services wait
+        for work and reply through the same route. The device's sockets
+        are kept in `sockets`, for `close` """
+
+        import nanomsg
+        from .rpc import Service
+
+        if count <= 1:
+            return [Service(address, self.codecs, self.metrics.compression)]
+
+        backend = 'inproc://oi-{}'.format(uuid.uuid4().hex)
+
+        front = nanomsg.Socket(nanomsg.REP, domain=nanomsg.AF_SP_RAW)
+        front.bind(address)
+        back = nanomsg.Socket(nanomsg.REQ, domain=nanomsg.AF_SP_RAW)
+        back.bind(backend)
+        self.sockets.extend([front, back])
+        self.workers.append(worker.DeviceWorker(front, back))
+
+        return [
+            Service(backend, self.codecs, self.metrics.compression, bind=False)
+            for _ in range(count)]
+
+    def dispatch(self, command, *args):
+        """ Run a registered command. Every request from a ctl,
+        including each command of a batch, goes through here """
+
+        try:
+            entry = self.registered[command]
+        except KeyError:
+            raise Exception('Method `{}` not found'.format(command))
+
+        stats = self.metrics.command(command)
+        if context.expired():
+            stats.expired()
+            raise context.DeadlineExceeded('deadline exceeded')
+
+        limit = entry.get('limit')
+        if limit is not None and not limit.acquire(False):
+            stats.refused()
+            raise admission.Busy('`{}` is running {} times already'.format(
+                command, entry['max_concurrency']))
+
+        stats.started()
+        start, error, dropped = compat.perf_counter(), True, False
+        try:
+            results = entry.get('cache')
+            if results is None:
+                result = self.share(entry, args, stats)
+            else:
+                hit, result = results.get(args)
+                if not hit:
+                    result = self.share(entry, args, stats)
+                    if not stream.is_iterator(result):
+                        results.put(args, result)
+            error = False
+            return result
+        except context.DeadlineExceeded:
+            dropped = True
+            stats.expired(started=True)
+            raise
+        except admission.Busy:
+            dropped = True
+            stats.refused(started=True)
+            raise
+        finally:
+            if not dropped:
+                stats.finished((compat.perf_counter() - start) * 1000, error)
+            if limit is not None:
+                limit.release()
+
+    def pool(self, kind):
+        """ The shared 'thread' or 'process' pool, started on first use """
+        with self.pools_lock:
+            if kind not in self.pools:
+                from concurrent import futures
+                pool_class = {
+                    'thread': futures.ThreadPoolExecutor,
+                    'process': futures.ProcessPoolExecutor,
+                }[kind]
+                self.pools[kind] = pool_class(self.pool_sizes[kind])
+            return self.pools[kind]
+
+    def share(self, entry, args, stats):
+        """ Invoke a command, sharing the result of an identical call
+        already running if the command coalesces. Iterators can only be
+        consumed once, so those get a run of their own """
+        flights = entry.get('flights')
+        if flights is None:
+            return self.invoke(entry, args)
+        shared, result = flights.do(args, lambda: self.invoke(entry, args))
+        if not shared:
+            return result
+        if stream.is_iterator(result):
+            return self.invoke(entry, args)
+        stats.coalesced()
+        return result
+
+    def invoke(self, entry, args):
+        """ Run the function of a registered command, in its executor's
+        pool if it has one. Results and exceptions come back either way.
+        Waiting for a pool stops at the caller's deadline """
+        kind = entry.get('executor')
+        if kind is None:
+            return entry['function'](*args)
+
+        from concurrent import futures
+
+        with self.pools_lock:
+            if (self.max_queue is not None and self.pool_jobs[kind] >=
+                    self.pool_sizes[kind] + self.max_queue):
+                raise admission.Busy('{} pool queue is full'.format(kind))
+            self.pool_jobs[kind] += 1
+
+        def done(future):
+            with self.pools_lock:
+                self.pool_jobs[kind] -= 1
+
+        try:
+            future = self.pool(kind).submit(
+                context.call, entry['function'], context.deadline(), *args)
+        except Exception:
+            done(None)
+            raise
+        # A job keeps its place in the pool until it is over, even if
+        # nobody waits for it anymore
+        future.add_done_callback(done)
+
+        remaining = context.remaining()
+        try:
+            return future.result(
+                None if remaining is None else max(remaining, 0))
+        except futures.TimeoutError:
+            # The caller gave up; don't start the job if still queued
+            future.cancel()
+            raise context.DeadlineExceeded('deadline exceeded')
+
+    def remaining(self):
+        """ Seconds until the caller of the command being handled gives
+        up waiting, or None if it has no deadline """
+        return context.remaining()
+
+    def handle(self, command, *args):
+        """ Answer a request from a ctl. Iterator results are streamed """
+        result = self.dispatch(command, *args)
+        if stream.is_iterator(result):
+            return self.streams.start(result)
+        return result
+
+    def batch_function(self, *calls):
+        """ Run [command, args] calls in order. Return a [result, error]
+        pair for each, so one failing command doesn't spoil the rest """
+
+        replies = []
+        for command, args in calls:
+            try:
+                result = self.dispatch(command, *args)
+                if stream.is_iterator(result):
+                    result = list(result)
+                replies.append([result, None])
+            except Exception as e:
+                replies.append([None, str(e)])
+        return replies
+
+    def stats_function(self, fmt='text'):
+        """ Show metrics for every command called so far """
+        if fmt == 'json':
+            return self.metrics.to_json()
+        return self.metrics.to_text()
 
     def help_function(self, command=None):
-        """ Show help for all available commands or just a single one """
+        """ Show help for all available commands or just a single one.
+        Cached commands are marked as such """
+
+        def cached(command):
+            results = self.registered[command].get('cache')
+            if results is None:
+                return ''
+            return ' (cached {}s)'.format(results.ttl)
+
         if command:
-            return self.registered[command].get(
-                'description', 'No help available'
-            )
-        return ', '.join(sorted(self.registered))
+            description = self.registered[command].get(
+                'description') or 'No help available'
+            return description + cached(command)
+        return ', '.join(c + cached(c) for c in sorted(self.registered))
+
+    def profile_function(self, action='top', arg=None):
+        """ Drive the sampling profiler """
+        if action == 'start':
+            return self.profiler.start(float(arg) / 1000 if arg else None)
+        if action == 'stop':
+            return self.profiler.stop()
+        if action == 'top':
+            return self.profiler.top(int(arg) if arg else 20)
+        raise ValueError('Unknown profile action `{}`'.format(action))
+
+    def memtop_function(self, arg=10):
+        """ Compare allocations with the previous call """
+        if arg == 'stop':
+            return self.memory.stop()
+        return self.memory.top(int(arg))
+
+    def add_command(self, command, function, description=None,
+                    cache_ttl=None, max_entries=128, executor=None,
+                    max_concurrency=None, coalesce=False):
+        """ Register a new function for command.
+
+        With `cache_ttl` (seconds) results are cached per arguments,
+        keeping at most `max_entries` of them. Only use this for commands
+        without side effects; call `invalidate` when the data behind
+        them changes.
+
+        With `executor` set to 'thread' or 'process' the function runs
+        in the program's shared pool of that kind. Use 'process' for CPU
+        bound work; its function and arguments must be picklable. The
+        service worker waits for the job, so other commands are only
+        answered meanwhile with `service_workers` greater than 1, which
+        is required.
+
+        With `max_concurrency`, calls finding that many calls of the
+        command already running get a busy error right away, keeping
+        service workers free for other commands
+
+        With `coalesce`, calls arriving while an identical call (same
+        arguments) runs wait for it and share its result or error
+        instead of running again. Nothing is kept afterwards, so unlike
+        `cache_ttl` no result is ever stale """
+
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError(
+                "executor must be 'thread' or 'process', not {!r}".format(
+                    executor))
+        if executor and len(self.services) == 1:
+            raise ValueError(
+                'executor needs service_workers > 1; with a single service '
+                'worker, waiting for `{}` would stall every other '
+                'command'.format(command))
 
-    def add_command(self, command, function, description=None):
-        """ Register a new function for command """
         super(Program, self).add_command(command, function, description)
-        self.service.register(command, function)
+        self.registered[command]['executor'] = executor
+        if max_concurrency:
+            self.registered[command]['max_concurrency'] = max_concurrency
+            self.registered[command]['limit'] = threading.Semaphore(
+                max_concurrency)
+        if coalesce:
+            self.registered[command]['flights'] = cache.SingleFlight()
+        if cache_ttl:
+            self.registered[command]['cache'] = cache.TTLCache(
+                cache_ttl, max_entries)
+        for service in self.services:
+            service.register(command, functools.partial(self.handle, command))
+
+    def publish(self, topic, data):
+        """ Publish a custom event, if the program has a publish address """
+        if self.publisher is not None:
+            self.publisher.publish(topic, data)
+
+    def invalidate(self, command=None):
+        """ Drop cached results of `command`, or of every command """
+        commands = [command] if command else list(self.registered)
+        for command in commands:
+            results = self.registered[command].get('cache')
+            if results is not None:
+                results.clear()
+
+    def close(self):
+        """ Close the sockets of the program and stop its pools """
+        for service in self.services:
+            service.socket.close()
+        for socket in self.sockets:
+            socket.close()
+        del self.sockets[:]
+        if self.publisher is not None:
+            self.publisher.close()
+        for pool in list(self.pools.values()):
+            pool.shutdown(wait=False)
 
     def run(self, args=None):
         """ Parse comand line arguments/flags and run program """
@@ -137,43 +704,263 @@ class Program(BaseProgram):
             self.config.read(filepath)
 
         # Start workers then wait until they finish work
-        [w.start() for w in self.workers]
-        [w.join() for w in self.workers]
+        try:
+            [w.start() for w in self.workers]
+            [w.join() for w in self.workers]
+        finally:
+            self.close()
 
 
 class ClientWrapper(object):
     """ An wrapper over nanoservice.Client to deal with one or multiple
-    clients in a similar fasion """
-
-    def __init__(self, address, timeout):
+    clients in a similar fasion
+
+    With multiple addresses each endpoint gets a circuit breaker (see
+    `health.Health`): after `failure_threshold` consecutive failures
+    calls to it fail fast, and a background thread pings it every
+    `reset_timeout` seconds until it answers again.
+
+    `retry` - an `admission.RetryPolicy` for busy replies
+    `tracer` - a `tracing.Tracer` timing the stages of each call
+    `codec` - the codec requests are sent in, see `codec`
+    `compression` - 'zlib', 'lz4' or None; large requests and replies
+    to tcp:// addresses are compressed with it. Other transports are
+    local, where compressing would only cost CPU """
+
+    failure_threshold = 3
+    reset_timeout = 5.0
+    retry = None
+    tracer = None
+    codec = 'msgpack'
+    compression = None
+    compression_stats = None
+    closed = False
+    _health = None
+    _prober = None
+
+    def __init__(self, address, timeout, max_workers=32, retry=None,
+                 tracer=None, codec='msgpack', compression='zlib'):
+        self.timeout = timeout
+        self.codec = codec
+        self.compression = compression
+        self.compression_stats = metrics.CompressionStats()
+        self.max_workers = max_workers
+        self.retry = retry
+        self.tracer = tracer
+        self._health = {}
+        self._probe_lock = threading.Lock()
+        self._in_use = set()
+        self._clients_lock = threading.Lock()
         self.c = self.create_client(address, timeout)
 
+    def new_client(self, addr, timeout):
+        """ Create a single client connected to addr """
+        from .rpc import Client
+        compress = self.compression if addr.startswith('tcp://') else None
+        c = Client(addr, timeout, self.codec, compress, self.compression_stats)
+        c.socket._set_recv_timeout(timeout)
+        c.tracer = self.tracer
+        return c
+
     def create_client(self, addr, timeout):
         """ Create client(s) based on addr """
-
-        def make(addr):
-            c = Client(addr)
-            c.socket._set_recv_timeout(timeout)
-            return c
-
         if ',' in addr:
             addrs = addr.split(',')
             addrs = [a.strip() for a in addrs]
-            return {a: make(a) for a in addrs}
-        return make(addr)
+            return {a: self.new_client(a, timeout) for a in addrs}
+        return self.new_client(addr, timeout)
 
     def _call_single(self, client, command, *args):
         """ Call single """
+
+        def call():
+            try:
+                return client.call(command, *args)
+            except Exception as e:
+                return None, str(e)
+
+        return self._retrying(call)
+
+    def _retrying(self, call):
+        """ Run `call`, retrying busy replies if there is a retry policy """
+        if self.retry is None:
+            return call()
+        return self.retry.call(call, self.timeout / 1000.0)
+
+    def endpoint_health(self, addr):
+        """ The `health.Health` of endpoint `addr` """
+        if self._health is None:
+            self._health = {}
+        h = self._health.get(addr)
+        if h is None:
+            h = self._health.setdefault(addr, health.Health(
+                addr, self.failure_threshold, self.reset_timeout))
+        return h
+
+    def _reserve(self, addr):
+        """ Take the client of endpoint `addr` for a call. A call which
+        outlived the deadline of an earlier `_call_multi` may still be
+        using it, and a REQ socket carries one request at a time, so
+        then the endpoint gets a fresh client """
+        with self._clients_lock:
+            client = self.c[addr]
+            if client in self._in_use:
+                client = self.c[addr] = self.new_client(addr, self.timeout)
+            self._in_use.add(client)
+            return client
+
+    def _release(self, addr, client):
+        """ Give back a client, closing it if it was replaced meanwhile """
+        with self._clients_lock:
+            self._in_use.discard(client)
+            replaced = self.c.get(addr) is not client
+        if replaced:
+            client.socket.close()
+
+    def _call_endpoint(self, addr, command, *args):
+        """ Call one of several endpoints through its circuit breaker,
+        collecting streamed replies """
+        client = self._reserve(addr)
+        try:
+            res, err = self._call_client(addr, client, command, *args)
+            return self._drain(client, res, err)
+        finally:
+            self._release(addr, client)
+
+    def _call_client(self, addr, client, command, *args):
+        """ Call the `client` of endpoint `addr` through its breaker """
+
+        h = self.endpoint_health(addr)
+
+        def call():
+            if not h.allow():
+                return None, h.error()
+            start = compat.perf_counter()
+            try:
+                res, err = client.call(command, *args)
+            except Exception as e:
+                if h.failure():
+                    self._start_prober()
+                return None, str(e)
+            h.success((compat.perf_counter() - start) * 1000)
+            return res, err
+
+        return self._retrying(call)
+
+    def _start_prober(self):
+        with self._probe_lock:
+            if self._prober is None:
+                self._prober = threading.Thread(target=self._probe)
+                self._prober.daemon = True
+                self._prober.start()
+
+    def _probe(self):
+        """ Ping endpoints with an open breaker until all are closed """
+
+        while not self.closed:
+            time.sleep(min(1.0, self.reset_timeout))
+            with self._probe_lock:
+                if all(h.state == health.CLOSED
+                       for h in list(self._health.values())):
+                    self._prober = None
+                    return
+            for h in list(self._health.values()):
+                if h.addr not in self.c or not h.begin_probe():
+                    continue
+                client = self._reserve(h.addr)
+                start = compat.perf_counter()
+                try:
+                    client.call('ping')
+                except Exception:
+                    h.failure()
+                else:
+                    h.success((compat.perf_counter() - start) * 1000)
+                finally:
+                    self._release(h.addr, client)
+        self._prober = None
+
+    def status(self):
+        """ Health of each endpoint, by address """
+        return dict(
+            (addr, h) for addr, h in list((self._health or {}).items()))
+
+    def _iter_stream(self, client, chunk):
+        """ Yield the items of a streamed reply, pulling chunks as needed.
+        Closing the generator early makes the program drop the stream """
+
+        sid, done = chunk[stream.MARKER], False
+        try:
+            while True:
+                for item in chunk['items']:
+                    yield item
+                if not chunk['more']:
+                    done = True
+                    return
+                chunk, err = self._call_single(client, 'stream_next', sid)
+                if err:
+                    done = True
+                    raise Exception(err)
+        finally:
+            if not done:
+                self._call_single(client, 'stream_close', sid)
+
+    def _iter_reserved(self, addr, client, chunk):
+        """ `_iter_stream` over a reserved client, released once the
+        stream is done or closed """
+        items = self._iter_stream(client, chunk)
+        try:
+            for item in items:
+                yield item
+        finally:
+            items.close()
+            self._release(addr, client)
+
+    def _drain(self, client, res, err):
+        """ Collect every item of a streamed reply """
+        if err or not stream.is_stream(res):
+            return res, err
         try:
-            return client.call(command, *args)
+            return list(self._iter_stream(client, res)), None
         except Exception as e:
             return None, str(e)
 
     def _call_multi(self, clients, command, *args):
-        """ Call multi """
-        responses, errors = {}, {}
-        for addr, client in clients.items():
-            res, err = self._call_single(client, command, *args)
+        """ Call all clients concurrently, using a bounded pool of threads,
+        and gather their replies under a single overall deadline.
+        Endpoints which did not reply in time are reported as timed out """
+
+        responses = dict((addr, None) for addr in clients)
+        errors = dict((addr, 'timeout') for addr in clients)
+        jobs, replies = compat.queue.Queue(), compat.queue.Queue()
+
+        for addr in clients:
+            jobs.put(addr)
+
+        def work():
+            while True:
+                try:
+                    addr = jobs.get_nowait()
+                except compat.queue.Empty:
+                    return
+                res, err = self._call_endpoint(addr, command, *args)
+                replies.put((addr, res, err))
+
+        for _ in range(min(len(clients), self.max_workers)):
+            t = threading.Thread(target=work)
+            t.daemon = True
+            t.start()
+
+        # Each socket enforces its own receive timeout, so the slowest
+        # possible reply arrives within `timeout`; allow a little slack
+        deadline = time.time() + self.timeout / 1000.0 + 0.5
+        for _ in range(len(clients)):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                addr, res, err = replies.get(timeout=remaining)
+            except compat.queue.Empty:
+                break
             responses[addr] = res
             errors[addr] = err
         return responses, errors
@@ -182,30 +969,110 @@ class ClientWrapper(object):
         """ Call remote service(s) """
         if isinstance(self.c, dict):
             return self._call_multi(self.c, command, *args)
-        return self._call_single(self.c, command, *args)
+        res, err = self._call_single(self.c, command, *args)
+        return self._drain(self.c, res, err)
+
+    def iter_call(self, command, *args):
+        """ Like `call`, but a streamed reply from a single service comes
+        back as an iterator which fetches items as they are consumed """
+        if isinstance(self.c, dict):
+            return self._call_multi(self.c, command, *args)
+        res, err = self._call_single(self.c, command, *args)
+        if not err and stream.is_stream(res):
+            return self._iter_stream(self.c, res), None
+        return res, err
+
+    def call_many(self, calls):
+        """ Send a batch of (command, args) calls in a single round-trip.
+
+        Return a (res, err) pair for each call, shaped like the return
+        value of `call`. If the batch itself fails, every call gets
+        the batch error """
+
+        calls = [[command, list(args)] for command, args in calls]
+        replies, errors = self.call('batch', *calls)
+        return self._unpack_many(len(calls), replies, errors)
+
+    def _unpack_many(self, count, replies, errors, multi=None):
+        """ Turn the reply of a `batch` call into per-call pairs """
+
+        def unpack(replies, err):
+            if err or replies is None:
+                return [(None, err or 'no reply')] * count
+            return [(res, err) for res, err in replies]
+
+        if multi is None:
+            multi = self.is_multi()
+        if not multi:
+            return unpack(replies, errors)
+
+        per_addr = dict(
+            (addr, unpack(replies[addr], errors[addr])) for addr in replies)
+        return [
+            (dict((addr, per_addr[addr][i][0]) for addr in per_addr),
+             dict((addr, per_addr[addr][i][1]) for addr in per_addr))
+            for i in range(count)]
 
     def is_multi(self):
         """ Does this object include multiple clients """
         return isinstance(self.c, dict)
 
+    def is_broadcast(self, command, *args):
+        """ Will this call get a reply from every client """
+        return self.is_multi()
+
     def close(self):
         """ Close socket(s) """
+        self.closed = True
         if isinstance(self.c, dict):
             for client in self.c.values():
-                client.sock.close()
+                client.socket.close()
             return
         self.c.socket.close()
 
 
+class DirectClient(object):
+    """ Stands in for a nanoservice Client, calling a Program of the
+    same process without sockets or serialization. Arguments and
+    results are passed as they are, not copied """
+
+    def __init__(self, program, timeout=None):
+        self.program = program
+        self.timeout = timeout
+
+    def call(self, command, *args):
+        deadline = time.time() + self.timeout / 1000.0 if self.timeout else None
+        with context.request(deadline):
+            try:
+                return self.program.handle(command, *args), None
+            except Exception as e:
+                return None, str(e)
+
+
+class DirectClientWrapper(ClientWrapper):
+    """ A ClientWrapper calling `program` in this process directly.
+    Replies, errors, streams and batches behave as over a socket """
+
+    def __init__(self, program, timeout=3000, retry=None):
+        super(DirectClientWrapper, self).__init__(program, timeout, retry=retry)
+
+    def create_client(self, program, timeout):
+        return DirectClient(program, timeout)
+
+    def close(self):
+        self.closed = True
+
+
 class Response(object):
     """ A local or remote response for a command """
 
-    def __init__(self, kind, res, err, multi=False):
+    def __init__(self, kind, res, err, multi=False, status=None):
         super(Response, self).__init__()
         self.kind = kind
         self.res = res
         self.err = err
         self.multi = multi
+        self.status = status or {}
 
     def _show(self, res, err, prefix='', colored=False):
         """ Show result or error """
@@ -217,6 +1084,7 @@ class Response(object):
 
         if self.kind is 'remote':
             if colored:
+                from colorama import Fore
                 red, green, reset = Fore.RED, Fore.GREEN, Fore.RESET
             else:
                 red = green = reset = ''
@@ -226,12 +1094,32 @@ class Response(object):
                 what = prefix + green + str(res) + reset
             print(what)
 
+    def _show_stream(self):
+        """ Show items of a streamed result as they arrive.
+        Ctrl-C stops the stream """
+        try:
+            for item in self.res:
+                self._show(item, None)
+        except KeyboardInterrupt:
+            if hasattr(self.res, 'close'):
+                self.res.close()
+            print('(stopped)')
+        except Exception as e:
+            self._show(None, str(e))
+
     def show(self):
+        if stream.is_iterator(self.res):
+            return self._show_stream()
         if self.multi:
             for addr in self.res:
+                h = self.status.get(addr)
+                if h is not None and h.state != health.CLOSED:
+                    prefix = '- {} [{}]: '.format(addr, h.describe())
+                else:
+                    prefix = '- {}: '.format(addr)
                 self._show(
                     self.res[addr], self.err[addr],
-                    prefix='- {}: '.format(addr), colored=True
+                    prefix=prefix, colored=True
                 )
             return
         self._show(self.res, self.err)
@@ -252,9 +1140,16 @@ class CtlProgram(BaseProgram):
 
      """
 
-    def __init__(self, description, address, timeout=3000):
+    def __init__(self, description, address, timeout=3000,
+                 publish_address=None, sharded=False, codec='msgpack',
+                 direct=False):
         super(CtlProgram, self).__init__(description, address)
-        self.client = ClientWrapper(address, timeout) if address else None
+        self.timeout = timeout
+        self.publish_address = publish_address
+        self.sharded = sharded
+        self.codec = codec
+        self.direct = direct
+        self._client = None
 
         # Add command argument
         self.parser.add_argument(
@@ -263,6 +1158,40 @@ class CtlProgram(BaseProgram):
 
         # Add default commands
         self.add_command('quit', lambda p: sys.exit(0), 'quit ctl')
+        if publish_address:
+            self.add_command(
+                'watch', lambda p, prefix='': p.watch(prefix),
+                'print events as they happen, e.g. `watch state.user`')
+
+    def watch(self, prefix=''):
+        """ Print events whose topic starts with `prefix` until Ctrl-C """
+        try:
+            for topic, data in events.subscribe(self.publish_address, prefix):
+                print(events.describe(topic, data))
+        except KeyboardInterrupt:
+            pass
+        return '(stopped)'
+
+    @property
+    def client(self):
+        """ The ClientWrapper, only set up once a remote command is
+        called, so one-shot local commands and --version stay fast """
+        if self._client is None and self.address:
+            program = local_program(self.address) if self.direct else None
+            if program is not None:
+                self._client = DirectClientWrapper(program, self.timeout)
+            elif self.sharded:
+                from .shard import ShardedClientWrapper
+                self._client = ShardedClientWrapper(
+                    self.address, self.timeout, codec=self.codec)
+            else:
+                self._client = ClientWrapper(
+                    self.address, self.timeout, codec=self.codec)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
 
     def call(self, command, *args):
         """ Execute local OR remote command and show response """
@@ -279,13 +1208,49 @@ class CtlProgram(BaseProgram):
         except KeyError:
 
             # Execute remote command
-            res, err = self.client.call(command, *args)
-            return Response('remote', res, err, self.client.is_multi())
+            res, err = self.client.iter_call(command, *args)
+            multi = self.client.is_broadcast(command, *args)
+            return Response('remote', res, err, multi, self.client.status())
 
         # Local exception
         except Exception as e:
             return Response('local', res, str(e))
 
+    def call_many(self, calls):
+        """ Execute a list of (command, args) and return their responses.
+        Consecutive remote commands are sent together in one batch """
+
+        responses, pending = [], []
+
+        def flush():
+            if not pending:
+                return
+            replies = self.client.call_many(pending)
+            status = self.client.status()
+            for (command, args), (res, err) in zip(pending, replies):
+                multi = self.client.is_broadcast(command, *args)
+                responses.append(
+                    Response('remote', res, err, multi, status))
+            del pending[:]
+
+        for command, args in calls:
+            if command in self.registered:
+                flush()
+                responses.append(self.call(command, *args))
+            else:
+                pending.append((command, args))
+        flush()
+        return responses
+
+    def execute(self, calls):
+        """ Execute one or more parsed (command, args) calls
+        and return their responses """
+
+        if len(calls) > 1:
+            return self.call_many(calls)
+        command, args = calls[0]
+        return [self.call(command, *args)]
+
     def parse_input(self, text):
         """ Parse ctl user input. Double quotes are used
         to group together multi words arguments. """
@@ -300,13 +1265,15 @@ class CtlProgram(BaseProgram):
     def loop(self):
         """ Enter loop, read user input then run command. Repeat """
 
+        import readline  # noqa: line editing for the input prompt
+
         while True:
             text = compat.input('ctl > ')
-            command, args = self.parse_input(text)
-            if not command:
+            calls = [self.parse_input(t) for t in util.split_commands(text)]
+            calls = [(command, args) for command, args in calls if command]
+            if not calls:
                 continue
-            response = self.call(command, *args)
-            response.show()
+            [r.show() for r in self.execute(calls)]
 
     def run(self, args=None, loop=True):
 
@@ -317,11 +1284,10 @@ class CtlProgram(BaseProgram):
         if args.command:
             # command will come as a list (zero or more elements)
             # so, extract the first element as the command name
-            # and the rest will all be positional arguments
-            command = args.command[0]
-            args = args.command[1:] if len(args.command) > 1 else []
-            response = self.call(command, *args)
-            response.show()
+            # and the rest will all be positional arguments.
+            # Several commands separated by `;` are sent as a batch
+            calls = util.group_commands(args.command)
+            [r.show() for r in self.execute(calls)]
             sys.exit(0)
 
         # Enter command loop
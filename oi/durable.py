@@ -0,0 +1,306 @@
+# A State which survives restarts
+#
+# Every mutation is appended to a binary journal; from time to time
+# the whole state is written to a snapshot and the journal truncated.
+# On startup the snapshot and the journal tail are read back through
+# memory maps.
+#
+# Journal record layout: <length:u32><crc32:u32><pickled (op, args)>
+
+import os
+import mmap
+import time
+import zlib
+import struct
+import pickle
+import contextlib
+import tempfile
+import threading
+
+from .core import State
+
+__all__ = ['DurableState']
+
+HEADER = struct.Struct('<II')
+SNAPSHOT_MAGIC = b'OISNAP1\n'
+FSYNC_POLICIES = ('always', 'batch', 'never')
+
+
+def _read_mapped(path):
+    """ Return the contents of file at `path` through a read-only
+    memory map, or None if the file is missing or empty """
+    try:
+        fh = open(path, 'rb')
+    except IOError:
+        return None
+    with fh:
+        if not os.fstat(fh.fileno()).st_size:
+            return None
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Journal(object):
+    """ Append-only log of state mutations
+
+    `fsync` - 'always' to fsync after every write, 'batch' to fsync at
+    most every `fsync_interval` seconds, 'never' to leave it to the OS.
+
+    In batch mode a write landing within `fsync_interval` of the last
+    fsync starts a timer syncing it once the interval is up, so no write
+    stays unsynced for longer even if no other write follows """
+
+    def __init__(self, path, fsync='batch', fsync_interval=1.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of {}'.format(
+                ', '.join(FSYNC_POLICIES)))
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.records = 0
+        self.last_sync = time.time()
+        self.timer = None
+        self.fh = open(path, 'ab')
+
+    def replay(self):
+        """ Yield (op, args) for each intact record. A torn record at the
+        end, left by a crash mid-write, is cut off the journal """
+
+        data = _read_mapped(self.path)
+        if data is None:
+            return
+
+        offset, size = 0, len(data)
+        try:
+            while offset + HEADER.size <= size:
+                length, crc = HEADER.unpack_from(data, offset)
+                start, end = offset + HEADER.size, offset + HEADER.size + length
+                if end > size or zlib.crc32(data[start:end]) & 0xffffffff != crc:
+                    break
+                yield pickle.loads(data[start:end])
+                offset = end
+                self.records += 1
+        finally:
+            data.close()
+
+        if offset < size:
+            with self.lock:
+                self.fh.truncate(offset)
+
+    @staticmethod
+    def encode(op, args):
+        """ The record of a mutation """
+        payload = pickle.dumps((op, args), pickle.HIGHEST_PROTOCOL)
+        crc = zlib.crc32(payload) & 0xffffffff
+        return HEADER.pack(len(payload), crc) + payload
+
+    def append(self, op, args, record=None):
+        """ Append a record, encoding it unless given, and sync
+        according to the fsync policy """
+
+        if record is None:
+            record = self.encode(op, args)
+
+        with self.lock:
+            self.fh.write(record)
+            self.fh.flush()
+            self.records += 1
+            if self.fsync == 'always':
+                os.fsync(self.fh.fileno())
+            elif self.fsync == 'batch':
+                wait = self.last_sync + self.fsync_interval - time.time()
+                if wait <= 0:
+                    self._sync()
+                elif self.timer is None:
+                    self.timer = threading.Timer(wait, self.sync)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+    def _sync(self):
+        os.fsync(self.fh.fileno())
+        self.last_sync = time.time()
+
+    def sync(self):
+        """ fsync writes made since the last fsync """
+        with self.lock:
+            self.timer = None
+            if not self.fh.closed:
+                self._sync()
+
+    def reset(self):
+        """ Empty the journal, once its records are in a snapshot """
+        with self.lock:
+            self.fh.seek(0)
+            self.fh.truncate()
+            self.records = 0
+            if self.fsync != 'never':
+                os.fsync(self.fh.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.fh.flush()
+            if self.fsync != 'never':
+                os.fsync(self.fh.fileno())
+            self.fh.close()
+
+
+class DurableState(State):
+    """ A State persisted to `directory` as a snapshot plus a journal.
+
+    The journal is compacted into a new snapshot once it holds
+    `compact_every` records, or whenever `compact` is called.
+    See `Journal` for the `fsync` policies.
+
+    Values are pickled into the journal before they are stored, so
+    writing one which can't be pickled raises and changes nothing """
+
+    def __init__(self, directory, fsync='batch', fsync_interval=1.0,
+                 compact_every=100000):
+        super(DurableState, self).__init__()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        attrs = {
+            'directory': directory,
+            'snapshot_path': os.path.join(directory, 'state.snapshot'),
+            'compact_every': compact_every,
+            'journal': Journal(
+                os.path.join(directory, 'state.journal'),
+                fsync, fsync_interval),
+            '_loading': True,
+            '_compact_lock': threading.RLock(),
+            '_pending': threading.local(),
+        }
+        for name, value in attrs.items():
+            object.__setattr__(self, name, value)
+
+        self.load()
+        object.__setattr__(self, '_loading', False)
+
+    def __reduce__(self):
+        return State, (dict(self),)
+
+    def copy(self):
+        return State(self.snapshot())
+
+    def load(self):
+        """ Read the snapshot then replay the journal on top of it """
+
+        data = _read_mapped(self.snapshot_path)
+        if data is not None:
+            with data:
+                if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                    raise ValueError('{} is not a state snapshot'.format(
+                        self.snapshot_path))
+                view = memoryview(data)
+                try:
+                    self.update(pickle.loads(view[len(SNAPSHOT_MAGIC):]))
+                finally:
+                    view.release()
+
+        for op, args in self.journal.replay():
+            if op == 'set':
+                self[args[0]] = args[1]
+            elif op == 'del':
+                self.pop(args[0], None)
+            elif op == 'update':
+                self.update(args[0])
+            elif op == 'clear':
+                self.clear()
+
+    @contextlib.contextmanager
+    def _journaled(self, op, *args):
+        """ Encode the record of a write about to be made, failing it
+        before anything changes if it can't be pickled """
+        if self._loading:
+            yield
+            return
+        self._pending.record = Journal.encode(op, args)
+        try:
+            yield
+        finally:
+            self._pending.record = None
+
+    def _changed(self, op, *args):
+        if not self._loading:
+            record = getattr(self._pending, 'record', None)
+            self._pending.record = None
+            self.journal.append(op, args, record)
+        super(DurableState, self)._changed(op, *args)
+
+    def _maybe_compact(self):
+        if self._loading or self.journal.records < self.compact_every:
+            return
+        # Writers reaching the limit together compact once
+        with self._compact_lock:
+            if self.journal.records >= self.compact_every:
+                self.compact()
+
+    def compact(self):
+        """ Write the whole state to a new snapshot and empty the journal.
+        Writers wait until it is done """
+
+        with self._compact_lock, self._locked(shared=True):
+            if not self.journal.records:
+                return
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='state.snapshot.', suffix='.tmp', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    fh.write(SNAPSHOT_MAGIC)
+                    pickle.dump(dict(self), fh, pickle.HIGHEST_PROTOCOL)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.rename(tmp_path, self.snapshot_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self.journal.reset()
+
+    def close(self):
+        """ Flush and close the journal """
+        self.journal.close()
+
+    # Compaction needs every stripe, so it runs after a write has
+    # released its own lock
+
+    def __setitem__(self, key, value):
+        with self._journaled('set', key, value):
+            super(DurableState, self).__setitem__(key, value)
+        self._maybe_compact()
+
+    def __delitem__(self, key):
+        super(DurableState, self).__delitem__(key)
+        self._maybe_compact()
+
+    def pop(self, key, *default):
+        value = super(DurableState, self).pop(key, *default)
+        self._maybe_compact()
+        return value
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return super(DurableState, self).setdefault(key, default)
+        with self._journaled('set', key, default):
+            value = super(DurableState, self).setdefault(key, default)
+        self._maybe_compact()
+        return value
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        with self._journaled('update', items):
+            super(DurableState, self).update(items)
+        self._maybe_compact()
+
+    def popitem(self):
+        item = super(DurableState, self).popitem()
+        self._maybe_compact()
+        return item
+
+    def clear(self):
+        super(DurableState, self).clear()
+        self._maybe_compact()
@@ -0,0 +1,85 @@
+# Change events published by a program
+#
+# Each message is `<topic>\0<msgpack payload>`. Subscribers filter on
+# topic prefixes. State changes are published on `state.<key>`, so
+# `watch state.user` only receives changes of keys starting with `user`
+
+import logging
+
+SEPARATOR = b'\0'
+STATE_TOPIC = 'state.'
+
+
+def encode(topic, data):
+    from nanoservice.encoder import MsgPackEncoder
+    return topic.encode('utf-8') + SEPARATOR + MsgPackEncoder().encode(data)
+
+
+def decode(message):
+    from nanoservice.encoder import MsgPackEncoder
+    topic, _, data = message.partition(SEPARATOR)
+    return topic.decode('utf-8'), MsgPackEncoder().decode(data)
+
+
+class Publisher(object):
+    """ Publish events on a nanomsg PUB socket bound to `address` """
+
+    def __init__(self, address):
+        import nanomsg
+        self.address = address
+        self.socket = nanomsg.Socket(nanomsg.PUB)
+        self.socket.bind(address)
+
+    def publish(self, topic, data):
+        """ Send an event. Events which can't be encoded are logged
+        and dropped; publishing never fails the caller """
+        try:
+            self.socket.send(encode(topic, data))
+        except Exception as e:
+            logging.error('Could not publish on {}: {}'.format(topic, e))
+
+    def state_changed(self, op, *args):
+        """ State listener publishing every mutation """
+        if op == 'set':
+            self.publish(STATE_TOPIC + str(args[0]), {
+                'op': 'set', 'key': args[0], 'value': args[1]})
+        elif op == 'del':
+            self.publish(STATE_TOPIC + str(args[0]), {
+                'op': 'del', 'key': args[0]})
+        elif op == 'update':
+            for key, value in args[0].items():
+                self.publish(STATE_TOPIC + str(key), {
+                    'op': 'set', 'key': key, 'value': value})
+        elif op == 'clear':
+            self.publish(STATE_TOPIC, {'op': 'clear'})
+
+    def close(self):
+        self.socket.close()
+
+
+def subscribe(address, prefix=''):
+    """ Yield (topic, data) for every event published on `address`
+    whose topic starts with `prefix` """
+
+    import nanomsg
+    socket = nanomsg.Socket(nanomsg.SUB)
+    try:
+        socket.set_string_option(
+            nanomsg.SUB, nanomsg.SUB_SUBSCRIBE, prefix.encode('utf-8'))
+        socket.connect(address)
+        while True:
+            yield decode(socket.recv())
+    finally:
+        socket.close()
+
+
+def describe(topic, data):
+    """ One line summary of an event, for the ctl """
+    if topic.startswith(STATE_TOPIC) and isinstance(data, dict):
+        if data.get('op') == 'set':
+            return 'set {} = {!r}'.format(data['key'], data['value'])
+        if data.get('op') == 'del':
+            return 'del {}'.format(data['key'])
+        if data.get('op') == 'clear':
+            return 'clear'
+    return '{}: {!r}'.format(topic, data)
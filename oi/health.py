@@ -0,0 +1,82 @@
+# Endpoint health tracking and circuit breaking for ClientWrapper
+#
+# An endpoint starts `closed` (calls go through). After `threshold`
+# consecutive transport failures it turns `open` and calls fail fast.
+# Once `reset_timeout` seconds have passed a probe `ping` is sent while
+# the endpoint is `half-open`; it closes again if the probe succeeds.
+
+import time
+import threading
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class Health(object):
+    """ The health of one endpoint: consecutive failures, a moving
+    average of its latency in ms and the state of its breaker """
+
+    def __init__(self, addr, threshold=3, reset_timeout=5.0, alpha=0.2):
+        self.addr = addr
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.alpha = alpha
+        self.state = CLOSED
+        self.failures = 0
+        self.latency = None
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ May a call go to this endpoint """
+        return self.state == CLOSED
+
+    def success(self, latency):
+        """ Note a reply which took `latency` ms """
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+            self.failures = 0
+            self.state = CLOSED
+
+    def failure(self):
+        """ Note a transport failure. Return True if it opened the breaker """
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (
+                    self.state == CLOSED and self.failures >= self.threshold):
+                self.state = OPEN
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def begin_probe(self):
+        """ Turn half-open if the breaker has been open long enough.
+        Return True if the caller should probe the endpoint now """
+        with self.lock:
+            if (self.state != OPEN or
+                    time.time() - self.opened_at < self.reset_timeout):
+                return False
+            self.state = HALF_OPEN
+            return True
+
+    def error(self):
+        """ The error given to calls refused by an open breaker """
+        return 'unavailable: circuit {} after {} failures'.format(
+            self.state, self.failures)
+
+    def describe(self):
+        parts = [self.state]
+        if self.state != CLOSED:
+            parts.append('{} failures'.format(self.failures))
+        if self.latency is not None:
+            parts.append('{:.1f}ms'.format(self.latency))
+        return ', '.join(parts)
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'latency': self.latency,
+        }
@@ -0,0 +1,223 @@
+# Per-command call metrics
+
+import json
+import bisect
+import threading
+
+# Upper bounds of the latency buckets, in milliseconds. The last
+# bucket catches everything slower
+BUCKETS = (
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+    1000, 2500, 5000, 10000, float('inf'))
+
+
+def _finite(value):
+    """ Percentiles in the last bucket have no upper bound. JSON can't
+    tell infinity, so they are reported as None """
+    return None if value == float('inf') else value
+
+
+class Histogram(object):
+    """ Fixed bucket latency histogram. Percentiles are reported as
+    the upper bound of the bucket they fall in """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.total += 1
+
+    def percentile(self, p):
+        if not self.total:
+            return None
+        rank, seen = self.total * p / 100.0, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class CommandStats(object):
+    """ Calls, errors, calls in flight and latencies of a command """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.shed = 0
+        self.busy = 0
+        self.shared = 0
+        self.latency = Histogram()
+
+    def started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finished(self, ms, error=False):
+        with self.lock:
+            self.in_flight -= 1
+            self.calls += 1
+            if error:
+                self.errors += 1
+            self.latency.record(ms)
+
+    def expired(self, started=False):
+        """ Count a request dropped because its deadline passed, instead
+        of as a call if it had `started` """
+        with self.lock:
+            self.shed += 1
+            if started:
+                self.in_flight -= 1
+
+    def refused(self, started=False):
+        """ Count a request refused by admission control, instead of as
+        a call if it had `started` """
+        with self.lock:
+            self.busy += 1
+            if started:
+                self.in_flight -= 1
+
+    def coalesced(self):
+        """ Count a call answered by sharing an identical call's result """
+        with self.lock:
+            self.shared += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'shed': self.shed,
+                'busy': self.busy,
+                'shared': self.shared,
+                'p50': _finite(self.latency.percentile(50)),
+                'p95': _finite(self.latency.percentile(95)),
+                'p99': _finite(self.latency.percentile(99)),
+            }
+
+
+class Transfer(object):
+    """ Messages going one way, their sizes before and on the wire and
+    the time spent (de)compressing them """
+
+    def __init__(self):
+        self.messages = 0
+        self.raw = 0
+        self.wire = 0
+        self.ms = 0.0
+
+    def add(self, raw, wire, ms):
+        self.messages += 1
+        self.raw += raw
+        self.wire += min(raw, wire)
+        self.ms += ms
+
+    def to_dict(self):
+        return {
+            'messages': self.messages,
+            'raw_bytes': self.raw,
+            'wire_bytes': self.wire,
+            'ratio': round(float(self.raw) / self.wire, 2)
+            if self.wire else None,
+            'ms': round(self.ms, 3),
+        }
+
+
+class CompressionStats(object):
+    """ Messages compressed before sending and decompressed after
+    receiving, counted apart """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = Transfer()
+        self.received = Transfer()
+
+    @property
+    def messages(self):
+        return self.sent.messages + self.received.messages
+
+    def compressed(self, raw, wire, ms):
+        with self.lock:
+            self.sent.add(raw, wire, ms)
+
+    def decompressed(self, raw, wire, ms):
+        with self.lock:
+            self.received.add(raw, wire, ms)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'sent': self.sent.to_dict(),
+                'received': self.received.to_dict(),
+            }
+
+    def to_text(self):
+        d = self.to_dict()
+        line = ('{messages} messages, {raw_bytes} bytes {way} as '
+                '{wire_bytes} (ratio {ratio}), {ms}ms')
+        return 'compression: ' + '; '.join(
+            line.format(way=way, **d[way])
+            for way in ('sent', 'received') if d[way]['messages'])
+
+
+class Metrics(object):
+    """ Stats for every command of a program, and of compressing the
+    messages of all of them """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.compression = CompressionStats()
+
+    def command(self, name):
+        """ Return the stats for command `name`, creating them if needed """
+        try:
+            return self.commands[name]
+        except KeyError:
+            with self.lock:
+                return self.commands.setdefault(name, CommandStats())
+
+    def to_dict(self):
+        return dict(
+            (name, stats.to_dict())
+            for name, stats in list(self.commands.items()))
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def to_text(self):
+        """ A table with a row per command; latencies in ms """
+
+        def fmt(value):
+            return '-' if value is None else '{:g}'.format(value)
+
+        def latency(value, stats):
+            if value is None and stats['calls']:
+                return '>{:g}'.format(BUCKETS[-2])
+            return fmt(value)
+
+        header = ('command', 'calls', 'errors', 'in flight', 'shed',
+                  'busy', 'shared', 'p50', 'p95', 'p99')
+        rows = [header]
+        for name, stats in sorted(self.to_dict().items()):
+            rows.append((
+                name, str(stats['calls']), str(stats['errors']),
+                str(stats['in_flight']), str(stats['shed']),
+                str(stats['busy']), str(stats['shared']),
+                latency(stats['p50'], stats), latency(stats['p95'], stats),
+                latency(stats['p99'], stats)))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        lines = [
+            '  '.join(col.ljust(w) for col, w in zip(row, widths)).rstrip()
+            for row in rows]
+        if self.compression.messages:
+            lines.append('')
+            lines.append(self.compression.to_text())
+        return '\n'.join(lines)
@@ -0,0 +1,150 @@
+# Live profiling of a running program
+#
+# `Profiler` samples the stacks of every thread, workers included, from
+# a background thread every `interval` seconds. Nothing is hooked into
+# the profiled code, so the overhead is that of the sampling thread
+# alone. `MemoryTracker` compares tracemalloc snapshots (Python 3.4+).
+
+import sys
+import time
+import os.path
+import threading
+import collections
+
+
+def _where(code):
+    return '{}:{} {}'.format(
+        os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+
+class Profiler(object):
+    """ A sampling profiler over all threads """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = 0
+            self.own = collections.Counter()
+            self.total = collections.Counter()
+            self.threads = collections.Counter()
+            self.started_at = time.time()
+            self.elapsed = 0.0
+
+    def start(self, interval=None):
+        """ Start sampling afresh """
+        if self.running:
+            return 'already profiling'
+        if interval:
+            self.interval = interval
+        self.reset()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='oi-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+        return 'profiling every {:g}ms'.format(self.interval * 1000)
+
+    def stop(self):
+        if not self.running:
+            return 'not profiling'
+        self.running = False
+        self.thread.join()
+        return '{} samples in {:.1f}s'.format(self.samples, self.elapsed)
+
+    def _run(self):
+        me = threading.current_thread().ident
+        while self.running:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            with self.lock:
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        self._sample(names.get(ident, ident), frame)
+                self.samples += 1
+                self.elapsed = time.time() - self.started_at
+            time.sleep(self.interval)
+
+    def _sample(self, thread, frame):
+        self.threads[thread] += 1
+        self.own[frame.f_code] += 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            if code not in seen:
+                seen.add(code)
+                self.total[code] += 1
+            frame = frame.f_back
+
+    def top(self, n=20):
+        """ The `n` functions found running most often, as text. `own` is
+        the share of stacks the function was running in, `total` the
+        share of stacks it was anywhere on """
+
+        with self.lock:
+            if not self.samples:
+                return 'no samples; run `profile start` first'
+            stacks = sum(self.threads.values())
+            rows = [('own', 'total', 'where')]
+            for code, count in self.own.most_common(n):
+                rows.append((
+                    '{:.1f}%'.format(100.0 * count / stacks),
+                    '{:.1f}%'.format(100.0 * self.total[code] / stacks),
+                    _where(code)))
+            threads = ', '.join(
+                '{} {:.0f}%'.format(name, 100.0 * c / stacks)
+                for name, c in self.threads.most_common())
+            header = '{} samples in {:.1f}s{}; threads: {}'.format(
+                self.samples, self.elapsed,
+                '' if self.running else ' (stopped)', threads)
+
+        widths = [max(len(row[i]) for row in rows) for i in range(2)]
+        return '\n'.join([header] + [
+            '{}  {}  {}'.format(
+                row[0].rjust(widths[0]), row[1].rjust(widths[1]), row[2])
+            for row in rows])
+
+
+class MemoryTracker(object):
+    """ Lines which allocated the most since the last look """
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.snapshot = None
+
+    def top(self, n=10):
+        """ Start tracing on the first call. Afterwards show the `n`
+        lines whose allocations grew the most since the previous call """
+
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.snapshot = tracemalloc.take_snapshot()
+            return 'tracing allocations; run `memtop` again to compare'
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+        stats = snapshot.compare_to(self.snapshot, 'lineno')[:n]
+        self.snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ['traced {:.1f} KiB, peak {:.1f} KiB'.format(
+            current / 1024.0, peak / 1024.0)]
+        for stat in stats:
+            frame = stat.traceback[0]
+            lines.append('{:+10.1f} KiB {:+8d} blocks  {}:{}'.format(
+                stat.size_diff / 1024.0, stat.count_diff,
+                os.path.basename(frame.filename), frame.lineno))
+        return '\n'.join(lines)
+
+    def stop(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            return 'not tracing'
+        tracemalloc.stop()
+        self.snapshot = None
+        return 'stopped tracing'
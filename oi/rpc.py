@@ -0,0 +1,153 @@
+# nanoservice endpoints speaking oi's request envelope
+#
+# A request is (method, args, ref, meta), where `meta` is a dict of
+# request metadata: `deadline` is the absolute time (time.time()) after
+# which the caller no longer waits, `sent` when it was sent and
+# `compress` the compression the reply may use, if large. Plain
+# (method, args, ref) requests from older clients are still accepted.
+#
+# Given a `tracing.Tracer`, both ends time the stages of each request.
+# Messages are encoded with the codecs of `codec.WireEncoder`.
+
+import time
+import logging
+
+from nanoservice import Client as BaseClient
+from nanoservice import Service as BaseService
+from nanoservice import RequestParseError
+
+from . import context
+from . import admission
+from .codec import WireEncoder
+from .codec import COMPRESSORS
+
+# Codecs a program accepts unless told otherwise; not pickle, which
+# would let anyone able to connect run code in the program
+CODECS = ('msgpack', 'json')
+
+
+class Service(BaseService):
+    """ A Service which runs each request in its context, and replies
+    in the codec of the request, out of `codecs`, compressed as the
+    request asks. Compression is measured into `stats` """
+
+    meta = None
+    tracer = None
+    times = None
+    request = None
+
+    def __init__(self, address, codecs=CODECS, stats=None, **kwargs):
+        kwargs.setdefault('encoder', WireEncoder(
+            accept=codecs, reply_in_kind=True, stats=stats))
+        super(Service, self).__init__(address, **kwargs)
+
+    def receive(self, decode=True):
+        payload = self.socket.recv()
+        received = time.time()
+        payload = self.verify(payload)
+        if decode:
+            payload = self.decode(payload)
+        self.times = [received, time.time()]
+        return payload
+
+    def parse(self, payload):
+        """ Parse a request, keeping its metadata aside """
+        try:
+            if len(payload) == 4:
+                method, args, ref, meta = payload
+            else:
+                (method, args, ref), meta = payload, None
+        except Exception as e:
+            raise RequestParseError(e)
+        self.meta = meta if isinstance(meta, dict) else {}
+        return method, args, ref
+
+    def execute(self, method, args, ref):
+        meta, self.meta = self.meta or {}, None
+        self.encoder.compress = COMPRESSORS.get(meta.get('compress'))
+        with context.request(meta.get('deadline')):
+            response = self.respond(method, args, ref)
+        if self.tracer is not None:
+            self.times = [meta.get('sent')] + self.times + [time.time()]
+            self.request = (ref, method, response['error'])
+        return response
+
+    def respond(self, method, args, ref):
+        """ Run the method, as nanoservice's `execute` does. Shed and
+        refused requests are how an overloaded program copes, so they
+        aren't logged as errors, with a traceback each """
+
+        response = {'result': None, 'error': None, 'ref': ref}
+        function = self.methods.get(method)
+        if not function:
+            response['error'] = 'Method `{}` not found'.format(method)
+            return response
+        try:
+            response['result'] = function(*args)
+        except (context.DeadlineExceeded, admission.Busy) as e:
+            logging.debug('%s: %s', method, e)
+            response['error'] = str(e)
+        except Exception as e:
+            logging.error(e, exc_info=1)
+            response['error'] = str(e)
+        return response
+
+    def send(self, payload):
+        super(Service, self).send(payload)
+        times, self.times = self.times, None
+        if self.tracer is not None and times and len(times) == 4:
+            ref, method, error = self.request
+            self.tracer.record(
+                ref, 'service', method, times + [time.time()], error)
+
+
+class Client(BaseClient):
+    """ A Client stamping each request with a deadline `timeout` ms
+    from when it is sent, and encoding it with `codec`. With `compress`
+    large requests and replies are compressed """
+
+    tracer = None
+    compress = None
+
+    def __init__(self, address, timeout=None, codec='msgpack', compress=None,
+                 stats=None, **kwargs):
+        kwargs.setdefault('encoder', WireEncoder(
+            codec, compress=compress, stats=stats))
+        super(Client, self).__init__(address, **kwargs)
+        self.timeout = timeout
+        self.compress = compress
+
+    def build_payload(self, method, args):
+        method, args, ref = super(Client, self).build_payload(method, args)
+        now = time.time()
+        meta = {'sent': now}
+        if self.timeout:
+            meta['deadline'] = now + self.timeout / 1000.0
+        if self.compress:
+            meta['compress'] = self.compress
+        return (method, args, ref, meta)
+
+    def check_reply(self, payload, res):
+        """ Make sure `res` is the reply to request `payload` """
+        if not isinstance(res, dict):
+            raise Exception(
+                'The program could not read the request; does it accept '
+                'codec `{}`?'.format(self.encoder.codec.name))
+        assert payload[2] == res['ref']
+
+    def call(self, method, *args):
+        start = time.time()
+        payload = self.build_payload(method, args)
+        data = self.sign(self.encode(payload))
+        sending = time.time()
+        self.socket.send(data)
+        sent = time.time()
+        data = self.socket.recv()
+        received = time.time()
+        res = self.decode(self.verify(data))
+        self.check_reply(payload, res)
+        if self.tracer is not None:
+            self.tracer.record(
+                payload[2], 'client', method,
+                [start, sending, sent, received, time.time()], res['error'])
+        return res['result'], res['error']
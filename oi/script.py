@@ -4,6 +4,7 @@ import sys
 import random
 
 from . import core
+from . import bench
 
 
 # =========================================================
@@ -182,8 +183,10 @@ def init_new_project(program):
 
 def main():
     program = core.CtlProgram(
-        'init a new oi program in current empty directory', None)
+        'init a new oi program in current empty directory, '
+        'or benchmark round-trips with `bench [option=value ...]`', None)
     program.add_command('init', init_new_project)
+    program.add_command('bench', bench.bench)
     program.run(loop=False)
 
 
@@ -0,0 +1,182 @@
+# Spread one logical service over several Program instances
+#
+# Each call is routed to a single shard chosen by hashing a key taken
+# from the call (the first argument by default) onto a consistent hash
+# ring. Every shard owns `replicas` points on the ring, so adding or
+# removing one only moves the keys which land next to its points,
+# about 1/N of them, instead of reshuffling everything.
+
+import bisect
+import hashlib
+
+from .core import ClientWrapper
+from . import stream
+
+GLOBAL_COMMANDS = (
+    'ping', 'help', 'stats', 'state_since', 'trace', 'profile', 'memtop')
+
+
+def _hash(value):
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+def first_argument(command, args):
+    """ The default key: the first argument, or None (broadcast) for
+    commands called without arguments """
+    return args[0] if args else None
+
+
+class HashRing(object):
+    """ A consistent hash ring mapping keys to nodes """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.hashes = []
+        self.owners = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            h = _hash('{}#{}'.format(node, i))
+            if h in self.owners:
+                continue
+            bisect.insort(self.hashes, h)
+            self.owners[h] = node
+
+    def remove(self, node):
+        for h in [h for h, owner in self.owners.items() if owner == node]:
+            del self.owners[h]
+            self.hashes.pop(bisect.bisect_left(self.hashes, h))
+
+    def copy(self):
+        ring = HashRing(replicas=self.replicas)
+        ring.hashes = list(self.hashes)
+        ring.owners = dict(self.owners)
+        return ring
+
+    def nodes(self):
+        return sorted(set(self.owners.values()))
+
+    def node(self, key):
+        """ The node owning `key` """
+        if not self.hashes:
+            raise LookupError('No shards to route to')
+        i = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.owners[self.hashes[i]]
+
+
+class ShardedClientWrapper(ClientWrapper):
+    """ A ClientWrapper routing each call to one of the comma separated
+    addresses, by consistent hashing of a key.
+
+    `key` - a function (command, args) -> key; a key of None sends
+    the call to every shard. Defaults to the first argument
+    `global_commands` - commands always sent to every shard
+
+    `add_shard` and `remove_shard` swap in new clients and a new ring
+    instead of changing them, so calls in flight aren't disturbed """
+
+    def __init__(self, address, timeout, key=None, global_commands=None,
+                 replicas=100, max_workers=32, retry=None, tracer=None,
+                 codec='msgpack', compression='zlib'):
+        self.key = key or first_argument
+        self.global_commands = set(
+            GLOBAL_COMMANDS if global_commands is None else global_commands)
+        self.ring = HashRing(replicas=replicas)
+        super(ShardedClientWrapper, self).__init__(
+            address, timeout, max_workers, retry, tracer, codec,
+            compression)
+
+    def create_client(self, addr, timeout):
+        """ A client per address, even if there is only one """
+        clients = {}
+        for a in addr.split(','):
+            a = a.strip()
+            clients[a] = self.new_client(a, timeout)
+            self.ring.add(a)
+        return clients
+
+    def route(self, command, *args):
+        """ The address which handles this call, or None for all """
+        if command in self.global_commands:
+            return None
+        key = self.key(command, args)
+        if key is None:
+            return None
+        return self.ring.node(key)
+
+    def is_broadcast(self, command, *args):
+        return self.route(command, *args) is None
+
+    def call(self, command, *args):
+        """ Call the owning shard, or every shard """
+        addr = self.route(command, *args)
+        if addr is None:
+            return self._call_multi(self.c, command, *args)
+        return self._call_endpoint(addr, command, *args)
+
+    def iter_call(self, command, *args):
+        addr = self.route(command, *args)
+        if addr is None:
+            return self._call_multi(self.c, command, *args)
+        client = self._reserve(addr)
+        try:
+            res, err = self._call_client(addr, client, command, *args)
+        except Exception:
+            self._release(addr, client)
+            raise
+        if not err and stream.is_stream(res):
+            return self._iter_reserved(addr, client, res), None
+        self._release(addr, client)
+        return res, err
+
+    def call_many(self, calls):
+        """ Send a batch to each shard owning some of the calls, plus
+        one to every shard for broadcast calls. Replies come back in
+        the order of `calls` """
+
+        calls = [(command, list(args)) for command, args in calls]
+        groups = {}
+        for i, (command, args) in enumerate(calls):
+            groups.setdefault(self.route(command, *args), []).append(i)
+
+        replies = [None] * len(calls)
+        for addr, indexes in groups.items():
+            batch = [list(calls[i]) for i in indexes]
+            if addr is None:
+                res, err = self._call_multi(self.c, 'batch', *batch)
+                pairs = self._unpack_many(len(batch), res, err, multi=True)
+            else:
+                res, err = self._call_endpoint(addr, 'batch', *batch)
+                pairs = self._unpack_many(len(batch), res, err, multi=False)
+            for i, pair in zip(indexes, pairs):
+                replies[i] = pair
+        return replies
+
+    def add_shard(self, addr):
+        """ Start routing to `addr`. Only keys now owned by it move """
+        with self._clients_lock:
+            if addr in self.c:
+                return
+            clients, ring = dict(self.c), self.ring.copy()
+            clients[addr] = self.new_client(addr, self.timeout)
+            ring.add(addr)
+            self.c, self.ring = clients, ring
+
+    def remove_shard(self, addr):
+        """ Stop routing to `addr`; its keys move to the other shards.
+        A call still using its client closes it when done """
+        with self._clients_lock:
+            if addr not in self.c:
+                return
+            clients, ring = dict(self.c), self.ring.copy()
+            client = clients.pop(addr)
+            ring.remove(addr)
+            self.c, self.ring = clients, ring
+            self._health.pop(addr, None)
+            busy = client in self._in_use
+        if not busy:
+            client.socket.close()
@@ -0,0 +1,413 @@
+# A State mirrored into shared memory (Python 3.8+)
+#
+# The owning process keeps using a normal State; every change is also
+# written to a shared memory segment which other processes attach to
+# and read without a round-trip through the service socket.
+#
+# Segment layout:
+#
+#   header  <magic:8s><seq:u64><slots:u64><arena:u64><used:u64><count:u64>
+#   table   slots x <hash:u32><status:u32><offset:u64>
+#   arena   records <klen:u32><vlen:u32><key utf-8><pickled value>
+#
+# Records are only appended, so a record never changes once written
+# until the arena is compacted. The owner is the only writer; it makes
+# `seq` odd while it changes the table and even again when done, and
+# readers retry whenever `seq` moved under them (a seqlock).
+
+import time
+import zlib
+import struct
+import pickle
+import logging
+import threading
+
+from multiprocessing import shared_memory
+
+from .core import State
+
+MAGIC = b'OISHM001'
+HEADER = struct.Struct('<8sQQQQQ')
+SLOT = struct.Struct('<IIQ')
+RECORD = struct.Struct('<II')
+SEQ = struct.Struct('<Q')
+SEQ_OFFSET = 8
+
+EMPTY, LIVE, DELETED = 0, 1, 2
+
+_attach_lock = threading.Lock()
+
+
+def _hash(kb):
+    return zlib.crc32(kb) & 0xffffffff
+
+
+class Segment(object):
+    """ The shared memory segment and its fixed layout.
+
+    Readers finding a write in progress for longer than `read_timeout`
+    seconds give up, as its owner probably died halfway """
+
+    read_timeout = 1.0
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.buf = shm.buf
+        magic, _, slots, arena, _, _ = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a shared state'.format(shm.name))
+        self.slots = slots
+        self.arena_size = arena
+        self.table_offset = HEADER.size
+        self.arena_offset = HEADER.size + slots * SLOT.size
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, name, size, slots):
+        """ Create a segment with `slots` table entries and an arena
+        of `size` bytes """
+        total = HEADER.size + slots * SLOT.size + size
+        shm = shared_memory.SharedMemory(name=name, create=True, size=total)
+        HEADER.pack_into(shm.buf, 0, MAGIC, 0, slots, size, 0, 0)
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        """ Open an existing segment without taking ownership of it """
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 every process opening a segment registers
+            # it with its resource tracker, which unlinks it on exit.
+            # Keep readers from registering at all
+            from multiprocessing import resource_tracker
+            with _attach_lock:
+                register = resource_tracker.register
+                resource_tracker.register = lambda name, rtype: None
+                try:
+                    shm = shared_memory.SharedMemory(name=name)
+                finally:
+                    resource_tracker.register = register
+        return cls(shm)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # Header fields
+
+    def _header(self):
+        return HEADER.unpack_from(self.buf, 0)
+
+    def _set_header(self, used, count):
+        magic, seq, slots, arena, _, _ = self._header()
+        HEADER.pack_into(self.buf, 0, magic, seq, slots, arena, used, count)
+
+    def _seq(self):
+        return SEQ.unpack_from(self.buf, SEQ_OFFSET)[0]
+
+    def _bump(self):
+        SEQ.pack_into(self.buf, SEQ_OFFSET, self._seq() + 1)
+
+    # Lookups, shared by readers and the writer
+
+    def _slot(self, i):
+        return SLOT.unpack_from(self.buf, self.table_offset + i * SLOT.size)
+
+    def _record(self, offset):
+        """ Return (key bytes, value memoryview) of the record at `offset` """
+        start = self.arena_offset + offset
+        klen, vlen = RECORD.unpack_from(self.buf, start)
+        start += RECORD.size
+        return (bytes(self.buf[start:start + klen]),
+                self.buf[start + klen:start + klen + vlen])
+
+    def _find(self, kb):
+        """ Return (slot index, status, offset) of `kb`, or of the slot
+        where it would go """
+        h, free = _hash(kb), None
+        for n in range(self.slots):
+            i = (h + n) % self.slots
+            slot_hash, status, offset = self._slot(i)
+            if status == EMPTY:
+                return (i, EMPTY, 0) if free is None else (free, EMPTY, 0)
+            if status == DELETED:
+                free = i if free is None else free
+                continue
+            if slot_hash == h and self._record(offset)[0] == kb:
+                return i, LIVE, offset
+        if free is not None:
+            return free, EMPTY, 0
+        raise MemoryError('Shared state table is full')
+
+    def _read(self, operation):
+        """ Run a read `operation` until no write happened meanwhile """
+        deadline, spins = None, 0
+        while True:
+            before = self._seq()
+            if before & 1:
+                spins += 1
+                if spins < 100:
+                    continue
+                # A long write, or its writer is gone: back off
+                now = time.time()
+                if deadline is None:
+                    deadline = now + self.read_timeout
+                elif now > deadline:
+                    raise RuntimeError(
+                        'Shared state {} is stuck in a write; did its '
+                        'owner die?'.format(self.name))
+                time.sleep(0.001)
+                continue
+            try:
+                result = operation()
+            except Exception:
+                if self._seq() != before:
+                    continue
+                raise
+            if self._seq() == before:
+                return result
+
+    def get(self, key):
+        """ Return (found, value) for `key`. The value is unpickled
+        straight out of the shared buffer """
+        kb = key.encode('utf-8')
+
+        def lookup():
+            i, status, offset = self._find(kb)
+            if status != LIVE:
+                return False, None
+            return True, pickle.loads(self._record(offset)[1])
+
+        return self._read(lookup)
+
+    def keys(self):
+        def scan():
+            keys = []
+            for i in range(self.slots):
+                _, status, offset = self._slot(i)
+                if status == LIVE:
+                    keys.append(self._record(offset)[0].decode('utf-8'))
+            return keys
+        return self._read(scan)
+
+    def count(self):
+        return self._read(lambda: self._header()[5])
+
+    # Writes, only done by the owner
+
+    def set(self, key, value):
+        kb = key.encode('utf-8')
+        vb = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = RECORD.size + len(kb) + len(vb)
+
+        with self.lock:
+            used = self._header()[4]
+            if used + size > self.arena_size:
+                self._compact()
+                used = self._header()[4]
+                if used + size > self.arena_size:
+                    raise MemoryError('Shared state arena is full')
+
+            # The record lands past `used`, where readers don't look
+            start = self.arena_offset + used
+            RECORD.pack_into(self.buf, start, len(kb), len(vb))
+            start += RECORD.size
+            self.buf[start:start + len(kb)] = kb
+            self.buf[start + len(kb):start + size - RECORD.size] = vb
+
+            self._bump()
+            try:
+                i, status, _ = self._find(kb)
+                SLOT.pack_into(
+                    self.buf, self.table_offset + i * SLOT.size,
+                    _hash(kb), LIVE, used)
+                count = self._header()[5] + (status != LIVE)
+                self._set_header(used + size, count)
+            finally:
+                self._bump()
+
+    def delete(self, key):
+        kb = key.encode('utf-8')
+        with self.lock:
+            self._bump()
+            try:
+                try:
+                    i, status, offset = self._find(kb)
+                except MemoryError:
+                    return  # a full table without the key
+                if status == LIVE:
+                    SLOT.pack_into(
+                        self.buf, self.table_offset + i * SLOT.size,
+                        0, DELETED, 0)
+                    used, count = self._header()[4:6]
+                    self._set_header(used, count - 1)
+            finally:
+                self._bump()
+
+    def clear(self):
+        with self.lock:
+            self._bump()
+            try:
+                self._clear()
+            finally:
+                self._bump()
+
+    def _clear(self):
+        end = self.arena_offset
+        self.buf[self.table_offset:end] = bytes(end - self.table_offset)
+        self._set_header(0, 0)
+
+    def _compact(self):
+        """ Rewrite the arena with live records only """
+        live = []
+        for i in range(self.slots):
+            _, status, offset = self._slot(i)
+            if status == LIVE:
+                kb, vb = self._record(offset)
+                live.append((kb, bytes(vb)))
+
+        self._bump()
+        try:
+            self._clear()
+            used = 0
+            for kb, vb in live:
+                start = self.arena_offset + used
+                RECORD.pack_into(self.buf, start, len(kb), len(vb))
+                start += RECORD.size
+                self.buf[start:start + len(kb)] = kb
+                self.buf[start + len(kb):start + len(kb) + len(vb)] = vb
+                i, _, _ = self._find(kb)
+                SLOT.pack_into(
+                    self.buf, self.table_offset + i * SLOT.size,
+                    _hash(kb), LIVE, used)
+                used += RECORD.size + len(kb) + len(vb)
+            self._set_header(used, len(live))
+        finally:
+            self._bump()
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class SharedStateView(object):
+    """ Read-only access to a SharedState from another process """
+
+    def __init__(self, name):
+        self.segment = Segment.attach(name)
+
+    def __getitem__(self, key):
+        found, value = self.segment.get(key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __contains__(self, key):
+        return self.segment.get(key)[0]
+
+    def __iter__(self):
+        return iter(self.segment.keys())
+
+    def __len__(self):
+        return self.segment.count()
+
+    def get(self, key, default=None):
+        found, value = self.segment.get(key)
+        return value if found else default
+
+    def keys(self):
+        return self.segment.keys()
+
+    def items(self):
+        return [(key, self.get(key)) for key in self.keys()]
+
+    def close(self):
+        self.segment.close()
+
+
+def attach(name):
+    """ Attach to the shared state called `name` """
+    return SharedStateView(name)
+
+
+class SharedState(State):
+    """ A State whose contents are mirrored into shared memory, for child
+    processes and sibling workers to read without asking the service.
+
+    Keys must be strings. The arena holds `size` bytes of records and
+    the table up to `slots` keys; both are fixed at creation. Values
+    which can't be pickled, or don't fit in the arena or table, stay
+    local and are hidden from readers.
+
+    Pickling a SharedState (e.g. passing it to a child process) gives
+    a read-only `SharedStateView` of it """
+
+    def __init__(self, name=None, size=64 * 1024 * 1024, slots=65536):
+        super(SharedState, self).__init__()
+        object.__setattr__(self, '_segment', Segment.create(name, size, slots))
+
+    @property
+    def shm_name(self):
+        """ Name other processes attach to """
+        return self._segment.name
+
+    def __reduce__(self):
+        return attach, (self.shm_name,)
+
+    def copy(self):
+        return State(self.snapshot())
+
+    def _check_keys(self, keys):
+        for key in keys:
+            if not isinstance(key, str):
+                raise TypeError('SharedState keys must be strings')
+
+    def __setitem__(self, key, value):
+        self._check_keys([key])
+        super(SharedState, self).__setitem__(key, value)
+
+    def setdefault(self, key, default=None):
+        self._check_keys([key])
+        return super(SharedState, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        self._check_keys(items)
+        super(SharedState, self).update(items)
+
+    def _changed(self, op, *args):
+        if op == 'set':
+            self._mirror(args[0], args[1])
+        elif op == 'del':
+            self._segment.delete(args[0])
+        elif op == 'update':
+            for key, value in args[0].items():
+                self._mirror(key, value)
+        elif op == 'clear':
+            self._segment.clear()
+        super(SharedState, self)._changed(op, *args)
+
+    def _mirror(self, key, value):
+        try:
+            self._segment.set(key, value)
+        except (pickle.PicklingError, TypeError, AttributeError,
+                MemoryError) as e:
+            logging.error('Not sharing state key {}: {}'.format(key, e))
+            self._segment.delete(key)
+
+    def close(self):
+        """ Release and remove the shared memory segment """
+        self._segment.close()
+        self._segment.unlink()
@@ -0,0 +1,85 @@
+# Streaming of iterator results in bounded chunks
+#
+# When a command returns an iterator, the reply holds only its first
+# chunk plus a stream id. The client pulls the rest, chunk by chunk,
+# with the `stream_next` command, or drops it with `stream_close`
+
+import time
+import uuid
+import threading
+
+MARKER = '__oi_stream__'
+
+
+def is_iterator(value):
+    """ Is `value` an iterator (e.g. a generator) rather than a value """
+    try:
+        return iter(value) is value and not isinstance(value, (str, bytes))
+    except TypeError:
+        return False
+
+
+def is_stream(value):
+    """ Is `value` a chunk of a streamed reply """
+    return isinstance(value, dict) and MARKER in value
+
+
+class Streams(object):
+    """ Open streams of a program. Streams left idle for longer than
+    `idle_timeout` seconds, e.g. by a ctl which went away, are closed """
+
+    def __init__(self, chunk_size=1000, idle_timeout=60):
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.open = {}  # id -> [iterator, last used]
+
+    def start(self, iterator):
+        """ Register `iterator` and return its first chunk """
+        self.purge()
+        sid = uuid.uuid4().hex
+        with self.lock:
+            self.open[sid] = [iterator, time.time()]
+        return self.next(sid)
+
+    def next(self, sid):
+        """ Return the next chunk of stream `sid` """
+
+        with self.lock:
+            try:
+                entry = self.open[sid]
+            except KeyError:
+                raise Exception('Stream `{}` not found'.format(sid))
+            entry[1] = time.time()
+
+        items, more = [], True
+        try:
+            for item in entry[0]:
+                items.append(item)
+                if len(items) >= self.chunk_size:
+                    break
+            else:
+                more = False
+        except Exception:
+            self.close(sid)
+            raise
+
+        if not more:
+            self.close(sid)
+        return {MARKER: sid, 'items': items, 'more': more}
+
+    def close(self, sid):
+        """ Drop stream `sid` """
+        with self.lock:
+            entry = self.open.pop(sid, None)
+        if entry is not None and hasattr(entry[0], 'close'):
+            entry[0].close()
+        return True
+
+    def purge(self):
+        """ Close streams which have been idle for too long """
+        deadline = time.time() - self.idle_timeout
+        with self.lock:
+            stale = [sid for sid, e in self.open.items() if e[1] < deadline]
+        for sid in stale:
+            self.close(sid)
@@ -0,0 +1,103 @@
+# Request tracing
+#
+# Clients and services time the stages of each request and note them
+# as a record keyed by the request's `ref`, so the client and service
+# sides of a request can be joined:
+#
+#   client   serialize, send, wait (for the reply), decode
+#   service  queue (from the client stamping the request to the service
+#            receiving it: serialization, transport and waiting for a
+#            service worker; across hosts this needs synchronized
+#            clocks), decode, handler, reply
+#
+# The last `size` records are kept in memory and, given a `path`,
+# appended to it as NDJSON (one JSON object per line).
+
+import json
+import time
+import atexit
+import threading
+import collections
+
+SPANS = {
+    'client': ('serialize', 'send', 'wait', 'decode'),
+    'service': ('queue', 'decode', 'handler', 'reply'),
+}
+
+
+class Tracer(object):
+    """ A ring buffer of request traces, optionally flushed to `path`
+    every `flush_every` records and at exit """
+
+    def __init__(self, path=None, size=1000, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.records = collections.deque(maxlen=size)
+        self.pending = []
+        self.lock = threading.Lock()
+        if path:
+            atexit.register(self.flush)
+
+    def record(self, ref, side, command, times, error=False):
+        """ Note a request. `times` are the time.time() stamps which
+        start and end the spans of `side`, one more than there are spans;
+        a None first stamp skips the first span """
+
+        names = SPANS[side]
+        start = times[1] if times[0] is None else times[0]
+        record = {
+            'id': ref,
+            'side': side,
+            'command': command,
+            'at': round(start, 6),
+            'ms': round((times[-1] - start) * 1000, 3),
+            'spans': dict(
+                (name, round((end - begin) * 1000, 3))
+                for name, begin, end in zip(names, times, times[1:])
+                if begin is not None),
+            'error': bool(error),
+        }
+        self.records.append(record)
+        if self.path:
+            with self.lock:
+                self.pending.append(record)
+                if len(self.pending) < self.flush_every:
+                    return
+            self.flush()
+
+    def flush(self):
+        """ Append the records not written yet to the trace file """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            with open(self.path, 'a') as fh:
+                fh.write(''.join(
+                    json.dumps(r, sort_keys=True) + '\n' for r in pending))
+
+    def slowest(self, n=10, side=None):
+        records = [r for r in list(self.records)
+                   if side is None or r['side'] == side]
+        return sorted(records, key=lambda r: r['ms'], reverse=True)[:n]
+
+    def to_text(self, n=10, side='service'):
+        """ The `n` slowest recent requests with their spans, in ms """
+
+        records = self.slowest(n, side)
+        if not records:
+            return 'no requests traced'
+        names = SPANS[side]
+        header = ('id', 'command', 'at', 'ms') + names
+        rows = [header]
+        for r in records:
+            rows.append((
+                r['id'][:8], r['command'] + (' (err)' if r['error'] else ''),
+                time.strftime('%H:%M:%S', time.localtime(r['at'])),
+                '{:g}'.format(r['ms'])) + tuple(
+                    '{:g}'.format(r['spans'][name])
+                    if name in r['spans'] else '-' for name in names))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return '\n'.join(
+            '  '.join(col.ljust(w) for col, w in zip(row, widths)).rstrip()
+            for row in rows)
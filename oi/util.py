@@ -1,6 +1,8 @@
 # Utility functions that didn't fit anywhere else
 
 import re
+import threading
+import contextlib
 
 
 def split(text):
@@ -49,3 +51,93 @@ def split(text):
         parts.append(part.strip())
 
     return parts
+
+
+def split_commands(text):
+    """ Split text into commands separated by `;`, ignoring
+    any `;` which is double quoted """
+
+    commands, command, quoted = [], '', False
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        if char == ';' and not quoted:
+            commands.append(command)
+            command = ''
+            continue
+        command += char
+    commands.append(command)
+    return [c for c in commands if c.strip()]
+
+
+def group_commands(parts):
+    """ Group already split arguments into (command, args) pairs.
+    Commands are separated by `;`, either alone or ending an argument """
+
+    calls, current = [], []
+    for part in parts + [';']:
+        if part.endswith(';'):
+            part = part[:-1]
+            if part:
+                current.append(part)
+            if current:
+                calls.append((current[0], current[1:]))
+            current = []
+            continue
+        current.append(part)
+    return calls
+
+
+class RWLock(object):
+    """ A reader/writer lock: any number of readers or a single writer.
+
+    Writers only take a plain mutex and wait for readers to drain, which
+    keeps exclusive writes nearly as cheap as with `threading.Lock`.
+    Readers pass through the same mutex on the way in, so a waiting
+    writer holds off new readers """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._drained = threading.Condition(threading.Lock())
+        self._readers = 0
+
+    def acquire_read(self):
+        with self._mutex:
+            with self._drained:
+                self._readers += 1
+
+    def release_read(self):
+        with self._drained:
+            self._readers -= 1
+            if not self._readers:
+                self._drained.notify_all()
+
+    def acquire_write(self):
+        self._mutex.acquire()
+        # Readers can't come in while we hold the mutex, so the count
+        # only goes down from here
+        if self._readers:
+            with self._drained:
+                while self._readers:
+                    self._drained.wait()
+
+    def release_write(self):
+        self._mutex.release()
+
+    @contextlib.contextmanager
+    def reading(self):
+        """ Hold the lock shared for the duration of a `with` block """
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def writing(self):
+        """ Hold the lock exclusively for the duration of a `with` block """
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -21,3 +21,16 @@ class ServiceWorker(Worker):
 
     def run(self):
         self.service.start()
+
+
+class DeviceWorker(Worker):
+    """ Relay messages between a front and a back socket """
+
+    def __init__(self, front, back, **kwargs):
+        super(DeviceWorker, self).__init__(**kwargs)
+        self.front = front
+        self.back = back
+
+    def run(self):
+        import nanomsg
+        nanomsg.Device(self.front, self.back).start()
@@ -53,6 +53,7 @@ setup(
         'nose',
         'nanomsg',
         'nanoservice',
+        'msgpack',
         'colorama',
     ],
     dependency_links=[
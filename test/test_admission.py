@@ -0,0 +1,46 @@
+import unittest
+
+from oi import admission
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_is_busy(self):
+        self.assertTrue(admission.is_busy(str(admission.Busy('full'))))
+        self.assertFalse(admission.is_busy('timeout'))
+        self.assertFalse(admission.is_busy(None))
+
+    def test_delays(self):
+        policy = admission.RetryPolicy(4, 0.1, 0.3, jitter=False)
+        self.assertEqual(list(policy.delays()), [0.1, 0.2, 0.3, 0.3])
+
+    def test_retries_busy(self):
+        replies = [(None, 'busy: full'), (None, 'busy: full'), ('ok', None)]
+        policy = admission.RetryPolicy(3, 0.001)
+        self.assertEqual(policy.call(lambda: replies.pop(0)), ('ok', None))
+
+    def test_gives_up(self):
+        calls = []
+
+        def busy():
+            calls.append(1)
+            return None, 'busy: full'
+
+        policy = admission.RetryPolicy(2, 0.001)
+        self.assertEqual(policy.call(busy), (None, 'busy: full'))
+        self.assertEqual(len(calls), 3)
+
+        del calls[:]
+        policy = admission.RetryPolicy(5, 0.5)
+        policy.call(busy, budget=0.1)
+        self.assertEqual(len(calls), 1)
+
+    def test_other_errors_not_retried(self):
+        calls = []
+
+        def fail():
+            calls.append(1)
+            return None, 'Method `x` not found'
+
+        admission.RetryPolicy(3, 0.001).call(fail)
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,72 @@
+import os
+import asyncio
+import unittest
+
+from oi.aio import AsyncClientWrapper
+from oi.aio import AsyncCtlProgram
+
+
+class FakeAsyncClientWrapper(AsyncClientWrapper):
+    """ Replies after a per address delay instead of using sockets """
+
+    delays = {}
+
+    async def _request(self, addr, command, args):
+        await asyncio.sleep(self.delays.get(addr, 0))
+        if command == 'batch':
+            return [[c, None] for c, _ in args], None
+        return '{} {}'.format(addr, command), None
+
+
+class TestAsyncClientWrapper(unittest.TestCase):
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_call_single(self):
+        c = FakeAsyncClientWrapper('ipc:///tmp/a.sock')
+        res, err = self.run_async(c.call('ping'))
+        self.assertEqual(res, 'ipc:///tmp/a.sock ping')
+        self.assertIsNone(err)
+
+    def test_call_multi_with_timeout(self):
+        c = FakeAsyncClientWrapper('a, b', timeout=100)
+        c.delays = {'b': 5}
+        responses, errors = self.run_async(c.call('ping'))
+        self.assertEqual(responses['a'], 'a ping')
+        self.assertEqual(errors['b'], 'timeout')
+
+    def test_wait_for_readable(self):
+        r, w = os.pipe()
+
+        async def wait():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(AsyncClientWrapper._wait(r), 0.05)
+            os.write(w, b'x')
+            await asyncio.wait_for(AsyncClientWrapper._wait(r), 1)
+
+        try:
+            self.run_async(wait())
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_call_many(self):
+        c = FakeAsyncClientWrapper('a')
+        replies = self.run_async(c.call_many([('get', []), ('ping', [])]))
+        self.assertEqual(replies, [('get', None), ('ping', None)])
+
+
+class TestAsyncCtlProgram(unittest.TestCase):
+
+    def test_execute(self):
+        ctl = AsyncCtlProgram('programctl', None)
+        ctl.client = FakeAsyncClientWrapper('a')
+        ctl.add_command('local', lambda p: 'here')
+        responses = ctl.execute([('local', []), ('ping', [])])
+        self.assertEqual([r.kind for r in responses], ['local', 'remote'])
+        self.assertEqual(responses[1].res, 'ping')
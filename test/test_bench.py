@@ -0,0 +1,46 @@
+from oi import bench
+
+
+def test_parse_options():
+    options = bench.parse_options(['sizes=1,2', 'transports=ipc, tcp'])
+    assert options['sizes'] == [1, 2]
+    assert options['transports'] == ['ipc', 'tcp']
+    assert options['requests'] == int(bench.DEFAULTS['requests'])
+
+
+def test_parse_options_unknown():
+    try:
+        bench.parse_options(['speed=11'])
+    except ValueError:
+        return
+    assert False, 'unknown option accepted'
+
+
+def test_percentile():
+    assert bench.percentile([], 50) is None
+    assert bench.percentile([1, 2, 3, 4], 50) == 3
+    assert bench.percentile([1, 2, 3, 4], 99) == 4
+
+
+def test_parse_codecs():
+    options = bench.parse_options(['codecs=msgpack,json', 'payload=bytes'])
+    assert options['codecs'] == ['msgpack', 'json']
+    assert options['payload'] == 'bytes'
+    try:
+        bench.parse_options(['codecs=yaml'])
+    except ValueError:
+        return
+    assert False, 'unknown codec accepted'
+
+
+def test_codec_speed():
+    encode, decode = bench.codec_speed('json', b'x' * 1024, seconds=0.01)
+    assert encode > 0 and decode > 0
+
+
+def test_run_inproc():
+    results = bench.run(['inproc'], [16], [2], 20, workers=2)
+    assert len(results) == 1
+    assert results[0]['errors'] == 0
+    assert results[0]['ops_per_sec'] > 0
+    assert 'inproc' in bench.to_text(results)
@@ -0,0 +1,91 @@
+import time
+import threading
+import unittest
+
+from oi import context
+from oi.cache import TTLCache, SingleFlight
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        c = TTLCache(10)
+        self.assertEqual(c.get(('a',)), (False, None))
+        c.put(('a',), 1)
+        self.assertEqual(c.get(('a',)), (True, 1))
+        self.assertEqual(c.get(['a']), (False, None))
+
+    def test_expiry(self):
+        c = TTLCache(0.01)
+        c.put((), 1)
+        time.sleep(0.02)
+        self.assertEqual(c.get(()), (False, None))
+        self.assertEqual(len(c), 0)
+
+    def test_lru_eviction(self):
+        c = TTLCache(10, max_entries=2)
+        c.put((1,), 1)
+        c.put((2,), 2)
+        c.get((1,))
+        c.put((3,), 3)
+        self.assertTrue(c.get((1,))[0])
+        self.assertFalse(c.get((2,))[0])
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def slow(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(1)
+        if self.calls > 1:
+            raise ValueError('bad')
+        return self.calls
+
+    def run_together(self, n, args=()):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flights.do(args, self.slow))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        threads[0].start()
+        self.started.wait(1)
+        [t.start() for t in threads[1:]]
+        time.sleep(0.05)
+        self.release.set()
+        [t.join() for t in threads]
+        return results
+
+    def test_shares_one_call(self):
+        results = self.run_together(5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sorted(results), [(False, 1)] + [(True, 1)] * 4)
+        self.assertEqual(len(self.flights), 0)
+        self.assertEqual(self.flights.do((), lambda: 'fresh'), (False, 'fresh'))
+
+    def test_shares_errors(self):
+        self.calls = 1
+        results = self.run_together(3)
+        self.assertEqual(self.calls, 2)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    def test_waiters_keep_their_deadline(self):
+        thread = threading.Thread(target=self.flights.do, args=((), self.slow))
+        thread.start()
+        self.started.wait(1)
+        with context.request(time.time() + 0.05):
+            self.assertRaises(
+                context.DeadlineExceeded, self.flights.do, (), self.slow)
+        self.release.set()
+        thread.join()
+        self.assertEqual(self.calls, 1)
@@ -0,0 +1,97 @@
+import sys
+import unittest
+
+from oi import codec
+
+REPLY = {'result': [b'\x00\xff', u'caf\xe9', 1.5, None], 'error': None,
+         'ref': 'abc'}
+
+
+class TestCodecs(unittest.TestCase):
+
+    def roundtrip(self, name, data=REPLY):
+        client = codec.WireEncoder(name)
+        service = codec.WireEncoder(
+            accept=list(codec.CODECS), reply_in_kind=True)
+        request = service.decode(client.encode(data))
+        self.assertEqual(service.last.name, name)
+        return client.decode(service.encode(request))
+
+    def test_msgpack(self):
+        self.assertEqual(self.roundtrip('msgpack'), REPLY)
+
+    def test_json(self):
+        self.assertEqual(self.roundtrip('json'), REPLY)
+        self.assertTrue(codec.WireEncoder('json').encode([]).startswith(b'J'))
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'needs pickle protocol 5')
+    def test_pickle_buffers(self):
+        data = dict(REPLY, result=memoryview(b'x' * 100000))
+        message = codec.get('pickle').encode(data)
+        self.assertLess(message.index(b'x' * 100), 200)
+
+        reply = codec.WireEncoder('pickle').decode(message)
+        self.assertIsInstance(reply['result'], memoryview)
+        self.assertTrue(reply['result'].readonly)
+        self.assertEqual(reply['result'].tobytes(), b'x' * 100000)
+
+    def test_legacy_msgpack(self):
+        import msgpack
+        message = msgpack.packb(['ping', [], 'ref'])
+        self.assertEqual(
+            codec.WireEncoder().decode(message), ['ping', [], 'ref'])
+
+    def test_not_accepted(self):
+        service = codec.WireEncoder(accept=['msgpack'], reply_in_kind=True)
+        message = codec.WireEncoder('json').encode(['ping', [], 'ref'])
+        self.assertRaises(codec.CodecError, service.decode, message)
+        self.assertEqual(service.last.name, 'msgpack')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, codec.WireEncoder, 'yaml')
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_large_messages(self):
+        from oi import metrics
+        stats = metrics.CompressionStats()
+        sender = codec.WireEncoder(compress='zlib', threshold=1000, stats=stats)
+        receiver = codec.WireEncoder(stats=stats)
+
+        small = sender.encode({'result': 'x' * 10})
+        self.assertEqual(receiver.decode(small), {'result': 'x' * 10})
+        self.assertEqual(stats.messages, 0)
+
+        data = {'result': 'state line\n' * 10000}
+        message = sender.encode(data)
+        self.assertTrue(message.startswith(b'Z'))
+        self.assertLess(len(message), 1000)
+        self.assertEqual(receiver.decode(message), data)
+
+        d = stats.to_dict()
+        self.assertEqual(d['sent']['messages'], 1)
+        self.assertEqual(d['received']['messages'], 1)
+        self.assertGreater(d['sent']['ratio'], 50)
+        self.assertIn('received', stats.to_text())
+
+    def test_incompressible(self):
+        import os
+        sender = codec.WireEncoder(compress='zlib', threshold=10)
+        data = os.urandom(5000)
+        message = sender.encode(data)
+        self.assertFalse(message.startswith(b'Z'))
+        self.assertEqual(codec.WireEncoder().decode(message), data)
+
+    def test_max_size(self):
+        sender = codec.WireEncoder(compress='zlib', threshold=10)
+        message = sender.encode({'result': 'x' * 100000})
+        self.assertLess(len(message), 1000)
+        self.assertEqual(
+            codec.WireEncoder(max_size=200000).decode(message)['result'],
+            'x' * 100000)
+        self.assertRaises(codec.CodecError,
+                          codec.WireEncoder(max_size=10000).decode, message)
+
+    def test_unavailable(self):
+        self.assertRaises(ValueError, codec.compressor, 'brotli')
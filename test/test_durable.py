@@ -0,0 +1,126 @@
+import os
+import time
+import shutil
+import threading
+import tempfile
+import unittest
+
+import oi
+
+
+class TestDurableState(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reopen(self, state, **kwargs):
+        state.close()
+        return oi.DurableState(self.dir, **kwargs)
+
+    def test_restore_from_journal(self):
+        state = oi.DurableState(self.dir)
+        state.a = 1
+        state['b'] = [1, 2]
+        state.update(c=3, d=4)
+        del state.d
+        state.pop('missing', None)
+
+        state = self.reopen(state)
+        self.assertEqual(state.snapshot(), {'a': 1, 'b': [1, 2], 'c': 3})
+
+    def test_compaction(self):
+        state = oi.DurableState(self.dir, compact_every=10)
+        for i in range(25):
+            state[str(i)] = i
+        self.assertEqual(state.journal.records, 5)
+        self.assertTrue(os.path.exists(state.snapshot_path))
+
+        state = self.reopen(state, compact_every=10)
+        self.assertEqual(len(state), 25)
+        self.assertEqual(state['24'], 24)
+
+    def test_concurrent_compaction(self):
+        state = oi.DurableState(self.dir, compact_every=5, fsync='never')
+        errors = []
+
+        def write(n):
+            for i in range(300):
+                try:
+                    state['{}-{}'.format(n, i)] = i
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            [f for f in os.listdir(self.dir) if f.endswith('.tmp')], [])
+
+        state = self.reopen(state)
+        self.assertEqual(len(state), 2400)
+
+    def test_unpicklable_value_is_refused(self):
+        state = oi.DurableState(self.dir)
+        state.a = 1
+        self.assertRaises(Exception, setattr, state, 'f', lambda: 1)
+        self.assertRaises(Exception, state.update, g=lambda: 1)
+        self.assertEqual(state.snapshot(), {'a': 1})
+        self.assertEqual(state.changes_since(0)['version'], 1)
+        state.b = 2
+
+        state = self.reopen(state)
+        self.assertEqual(state.snapshot(), {'a': 1, 'b': 2})
+
+    def test_every_write_compacts(self):
+        state = oi.DurableState(self.dir, compact_every=2)
+        state.a, state.b = 1, 2
+        state.pop('a')
+        state.setdefault('c', 3)
+        state.popitem()
+        state.clear()
+        self.assertLess(state.journal.records, 2)
+        state.close()
+
+    def test_batch_fsync_without_later_writes(self):
+        state = oi.DurableState(self.dir, fsync_interval=0.05)
+        state.a = 1
+        synced = []
+        state.journal._sync = lambda: synced.append(True)
+        state.b = 2
+        self.assertEqual(synced, [])
+        time.sleep(0.2)
+        self.assertEqual(synced, [True])
+        state.close()
+
+    def test_namespace(self):
+        self.assertFalse(hasattr(oi, 'mmap'))
+        self.assertFalse(hasattr(oi, 'HEADER'))
+
+    def test_torn_record_is_dropped(self):
+        state = oi.DurableState(self.dir, fsync='always')
+        state.a = 1
+        state.b = 2
+        state.close()
+
+        with open(state.journal.path, 'ab') as fh:
+            fh.write(b'\x10\x00\x00\x00garbage')
+
+        state = oi.DurableState(self.dir)
+        self.assertEqual(state.snapshot(), {'a': 1, 'b': 2})
+        state.c = 3
+        state = self.reopen(state)
+        self.assertEqual(state.c, 3)
+
+    def test_pickles_as_plain_state(self):
+        import pickle
+        state = oi.DurableState(self.dir)
+        state.a = 1
+        copy = pickle.loads(pickle.dumps(state))
+        self.assertIs(type(copy), oi.State)
+
+    def test_bad_fsync_policy(self):
+        self.assertRaises(ValueError, oi.DurableState, self.dir, fsync='x')
@@ -0,0 +1,48 @@
+import unittest
+
+import oi
+from oi import events
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class TestPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = events.Publisher.__new__(events.Publisher)
+        self.publisher.socket = FakeSocket()
+        self.state = oi.State()
+        self.state.subscribe(self.publisher.state_changed)
+
+    def published(self):
+        return [events.decode(m) for m in self.publisher.socket.sent]
+
+    def test_state_changes(self):
+        self.state.user = 'abc'
+        self.state.update(a=1)
+        del self.state.user
+        self.state.clear()
+        self.assertEqual(self.published(), [
+            ('state.user', {'op': 'set', 'key': 'user', 'value': 'abc'}),
+            ('state.a', {'op': 'set', 'key': 'a', 'value': 1}),
+            ('state.user', {'op': 'del', 'key': 'user'}),
+            ('state.', {'op': 'clear'}),
+        ])
+
+    def test_unencodable_value_is_dropped(self):
+        self.state.obj = object()
+        self.assertEqual(self.state.obj.__class__, object)
+        self.assertEqual(self.published(), [])
+
+    def test_describe(self):
+        self.assertEqual(
+            events.describe('state.a', {'op': 'set', 'key': 'a', 'value': 1}),
+            'set a = 1')
+        self.assertEqual(events.describe('deploy', 'v2'), "deploy: 'v2'")
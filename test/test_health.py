@@ -0,0 +1,40 @@
+import time
+import unittest
+
+from oi import health
+
+
+class TestHealth(unittest.TestCase):
+
+    def test_opens_after_threshold(self):
+        h = health.Health('addr', threshold=2)
+        self.assertFalse(h.failure())
+        self.assertTrue(h.allow())
+        self.assertTrue(h.failure())
+        self.assertFalse(h.allow())
+        self.assertIn('circuit open after 2 failures', h.error())
+
+    def test_success_resets(self):
+        h = health.Health('addr', threshold=2)
+        h.failure()
+        h.success(10)
+        h.success(20)
+        self.assertEqual(h.failures, 0)
+        self.assertAlmostEqual(h.latency, 12)
+        self.assertEqual(h.describe(), 'closed, 12.0ms')
+
+    def test_half_open(self):
+        h = health.Health('addr', threshold=1, reset_timeout=0.05)
+        h.failure()
+        self.assertFalse(h.begin_probe())
+        time.sleep(0.06)
+        self.assertTrue(h.begin_probe())
+        self.assertEqual(h.state, health.HALF_OPEN)
+        self.assertFalse(h.allow())
+
+        self.assertTrue(h.failure())
+        self.assertEqual(h.state, health.OPEN)
+        time.sleep(0.06)
+        h.begin_probe()
+        h.success(1)
+        self.assertEqual(h.state, health.CLOSED)
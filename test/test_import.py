@@ -0,0 +1,39 @@
+# One-shot ctl invocations (health checks, cron) should not pay for
+# interactive or transport modules they don't use
+
+import sys
+import subprocess
+
+DEFERRED = ('readline', 'colorama', 'nanoservice', 'nanomsg',
+            'multiprocessing')
+
+SCRIPT = '''
+import sys
+import oi
+ctl = oi.CtlProgram('programctl', 'ipc:///tmp/test-import.sock')
+ctl.add_command('local', lambda p: 'local')
+ctl.call('local')
+print('loaded:' + ','.join(m for m in {!r} if m in sys.modules))
+'''.format(DEFERRED)
+
+
+def loaded_modules(script):
+    out = subprocess.check_output([sys.executable, '-c', script])
+    for line in out.decode('utf-8').splitlines():
+        if line.startswith('loaded:'):
+            return line[len('loaded:'):]
+
+
+def test_deferred_imports():
+    assert loaded_modules(SCRIPT) == ''
+
+
+def test_version_does_not_touch_transport():
+    script = SCRIPT.replace(
+        "ctl.call('local')",
+        "sys.argv = ['ctl', '--version']\n"
+        "try:\n"
+        "    ctl.run()\n"
+        "except SystemExit:\n"
+        "    pass\n")
+    assert loaded_modules(script) == ''
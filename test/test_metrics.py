@@ -0,0 +1,59 @@
+import json
+import unittest
+
+from oi import metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        h = metrics.Histogram()
+        self.assertIsNone(h.percentile(50))
+        for _ in range(90):
+            h.record(0.3)
+        for _ in range(10):
+            h.record(40)
+        self.assertEqual(h.percentile(50), 0.5)
+        self.assertEqual(h.percentile(95), 50)
+        self.assertEqual(h.percentile(99), 50)
+
+    def test_overflow_bucket(self):
+        h = metrics.Histogram()
+        h.record(10 ** 6)
+        self.assertEqual(h.percentile(99), float('inf'))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counts(self):
+        m = metrics.Metrics()
+        stats = m.command('ping')
+        stats.started()
+        self.assertEqual(m.to_dict()['ping']['in_flight'], 1)
+        stats.finished(1.0)
+        stats.started()
+        stats.finished(2.0, error=True)
+
+        d = json.loads(m.to_json())['ping']
+        self.assertEqual((d['calls'], d['errors'], d['in_flight']), (2, 1, 0))
+        self.assertIn('ping', m.to_text())
+
+    def test_slow_calls_stay_valid_json(self):
+        m = metrics.Metrics()
+        stats = m.command('slow')
+        stats.started()
+        stats.finished(10 ** 6)
+        self.assertIsNone(json.loads(m.to_json())['slow']['p99'])
+        self.assertIn('>10000', m.to_text())
+
+    def test_shed(self):
+        m = metrics.Metrics()
+        m.command('ping').expired()
+        self.assertEqual(m.to_dict()['ping']['shed'], 1)
+        self.assertIn('shed', m.to_text())
+
+    def test_shared(self):
+        m = metrics.Metrics()
+        m.command('state').coalesced()
+        self.assertEqual(m.to_dict()['state']['shared'], 1)
+        self.assertIn('shared', m.to_text())
@@ -1,5 +1,10 @@
+import json
+import time
+import pickle
+import threading
 import unittest
 import oi
+from oi import context
 
 
 class TestOi(unittest.TestCase):
@@ -50,6 +55,450 @@ class TestOi(unittest.TestCase):
             self.assertEqual(res, expected)
 
 
+class TestServiceWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.address = 'ipc:///tmp/test-programd-pool.sock'
+        self.p = oi.Program('programd', self.address, service_workers=2)
+        self.p.add_command('slow', lambda: time.sleep(1) or 'done')
+        for w in self.p.workers:
+            w.daemon = True
+            w.start()
+
+    def tearDown(self):
+        self.p.close()
+
+    def test_slow_command_does_not_block_ping(self):
+        slow = threading.Thread(target=lambda: oi.ClientWrapper(
+            self.address, 3000).call('slow'))
+        slow.start()
+        time.sleep(0.1)
+
+        client = oi.ClientWrapper(self.address, 3000)
+        start = time.time()
+        self.assertEqual(client.call('ping'), ('pong', None))
+        self.assertLess(time.time() - start, 0.5)
+        client.close()
+        slow.join()
+
+    def test_close(self):
+        self.assertEqual(len(self.p.sockets), 2)
+        self.p.close()
+        self.assertEqual(self.p.sockets, [])
+
+
+class SlowClient(object):
+
+    def __init__(self, delay, res):
+        self.delay, self.res = delay, res
+        self.socket = self
+        self.closed = False
+
+    def call(self, command, *args):
+        time.sleep(self.delay)
+        return self.res, None
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClientWrapper(oi.ClientWrapper):
+    """ Calls the given {address: client} instead of sockets. New
+    clients reply 'fresh' """
+
+    def create_client(self, clients, timeout):
+        return clients
+
+    def new_client(self, addr, timeout):
+        return SlowClient(0, 'fresh')
+
+
+class TestClientWrapper(unittest.TestCase):
+
+    def test_call_multi_concurrently(self):
+        w = FakeClientWrapper(dict(
+            ('addr{}'.format(i), SlowClient(0.2, i)) for i in range(5)), 3000)
+
+        start = time.time()
+        responses, errors = w.call('ping')
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(responses['addr3'], 3)
+        self.assertIsNone(errors['addr3'])
+
+    def test_call_multi_deadline(self):
+        w = FakeClientWrapper(
+            {'fast': SlowClient(0, 'pong'), 'dead': SlowClient(5, 'pong')}, 10)
+
+        responses, errors = w.call('ping')
+        self.assertEqual(responses['fast'], 'pong')
+        self.assertEqual(errors['dead'], 'timeout')
+
+    def test_busy_client_is_not_reused(self):
+        late = SlowClient(1, 'late')
+        w = FakeClientWrapper({'a': SlowClient(0, 'pong'), 'b': late}, 10)
+        self.assertEqual(w.call('ping')[1]['b'], 'timeout')
+
+        responses, errors = w.call('ping')
+        self.assertEqual(responses['b'], 'fresh')
+        time.sleep(1.2)
+        self.assertTrue(late.closed)
+
+
+class FlakyClient(object):
+
+    def __init__(self):
+        self.calls, self.down = 0, True
+
+    def call(self, command, *args):
+        self.calls += 1
+        if self.down:
+            raise Exception('Resource temporarily unavailable')
+        return 'pong', None
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.flaky = FlakyClient()
+        self.w = FakeClientWrapper(
+            {'up': SlowClient(0, 'pong'), 'down': self.flaky}, 3000)
+        self.w.reset_timeout = 0.05
+
+    def tearDown(self):
+        self.w.closed = True
+
+    def test_probe_lock_per_wrapper(self):
+        other = FakeClientWrapper({'up': SlowClient(0, 'pong')}, 3000)
+        self.assertIsNot(self.w._probe_lock, other._probe_lock)
+
+    def test_fails_fast_when_open(self):
+        for _ in range(5):
+            responses, errors = self.w.call('ping')
+        self.assertEqual(self.flaky.calls, 3)
+        self.assertEqual(responses['up'], 'pong')
+        self.assertIn('circuit open', errors['down'])
+        self.assertEqual(self.w.status()['down'].state, 'open')
+
+    def test_probe_closes(self):
+        for _ in range(3):
+            self.w.call('ping')
+        self.flaky.down = False
+        time.sleep(0.3)
+        self.assertEqual(self.w.status()['down'].state, 'closed')
+        self.assertEqual(self.w.call('ping')[0]['down'], 'pong')
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.p = oi.Program('programd', None)
+        self.p.add_command('get', lambda key: self.p.state[key])
+
+    def test_batch_function(self):
+        self.p.state['a'] = 1
+        replies = self.p.batch_function(['get', ['a']], ['get', ['b']])
+        self.assertEqual(replies[0], [1, None])
+        self.assertIsNone(replies[1][0])
+        self.assertIsNotNone(replies[1][1])
+
+    def test_call_many(self):
+        p = self.p
+
+        class DirectClient(object):
+            def call(self, command, *args):
+                return p.dispatch(command, *args), None
+
+        w = oi.ClientWrapper.__new__(oi.ClientWrapper)
+        w.c = DirectClient()
+        p.state['a'] = 1
+        replies = w.call_many([('get', ['a']), ('ping', [])])
+        self.assertEqual(replies, [(1, None), ('pong', None)])
+
+
+class TestCachedCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.p = oi.Program('programd', None)
+        self.p.add_command('count', self.count, 'count calls', cache_ttl=60)
+
+    def count(self, *args):
+        self.calls += 1
+        return self.calls
+
+    def test_cached(self):
+        self.assertEqual(self.p.dispatch('count'), 1)
+        self.assertEqual(self.p.dispatch('count'), 1)
+        self.assertEqual(self.p.dispatch('count', 'x'), 2)
+
+    def test_invalidate(self):
+        self.p.dispatch('count')
+        self.p.invalidate('count')
+        self.assertEqual(self.p.dispatch('count'), 2)
+
+    def test_help_shows_cached(self):
+        self.assertIn('count (cached 60s)', self.p.help_function())
+        self.assertEqual(self.p.help_function('count'), 'count calls (cached 60s)')
+        self.assertIn('help, ping', self.p.help_function())
+
+
+class TestCoalescedCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.p = oi.Program('programd', None)
+        self.p.add_command('slow', self.slow, coalesce=True)
+        self.p.add_command('numbers', lambda: iter([1, 2]), coalesce=True)
+
+    def slow(self, *args):
+        self.calls += 1
+        self.release.wait(1)
+        return {'calls': self.calls}
+
+    def test_concurrent_calls_share(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                self.p.dispatch('slow'))) for _ in range(10)]
+        [t.start() for t in threads]
+        time.sleep(0.1)
+        self.release.set()
+        [t.join() for t in threads]
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'calls': 1}] * 10)
+        stats = json.loads(self.p.dispatch('stats', 'json'))['slow']
+        self.assertEqual((stats['calls'], stats['shared']), (10, 9))
+
+    def test_nothing_kept(self):
+        self.release.set()
+        self.assertEqual(self.p.dispatch('slow'), {'calls': 1})
+        self.assertEqual(self.p.dispatch('slow'), {'calls': 2})
+
+    def test_iterators(self):
+        self.assertEqual(list(self.p.dispatch('numbers')), [1, 2])
+
+
+class TestStats(unittest.TestCase):
+
+    def test_dispatch_records_metrics(self):
+        p = oi.Program('programd', None)
+        p.dispatch('ping')
+        self.assertRaises(Exception, p.dispatch, 'help', 'missing')
+
+        stats = json.loads(p.dispatch('stats', 'json'))
+        self.assertEqual(stats['ping']['calls'], 1)
+        self.assertEqual(stats['help']['errors'], 1)
+        self.assertIn('command', p.dispatch('stats'))
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        p = self.p = oi.Program('programd', None, stream_chunk=3)
+        p.add_command('count', lambda n: (i for i in range(int(n))))
+        self.requests = []
+
+        class DirectClient(object):
+            def call(client, command, *args):
+                self.requests.append(command)
+                try:
+                    return p.handle(command, *args), None
+                except Exception as e:
+                    return None, str(e)
+
+        self.w = oi.ClientWrapper.__new__(oi.ClientWrapper)
+        self.w.c = DirectClient()
+
+    def test_call_collects_stream(self):
+        self.assertEqual(self.w.call('count', 7), (list(range(7)), None))
+        self.assertEqual(self.requests.count('stream_next'), 2)
+
+    def test_iter_call_stops_early(self):
+        res, err = self.w.iter_call('count', 100)
+        self.assertEqual([next(res) for _ in range(4)], [0, 1, 2, 3])
+        res.close()
+        self.assertEqual(self.requests[-1], 'stream_close')
+        self.assertEqual(self.p.streams.open, {})
+
+    def test_batch_collects_stream(self):
+        replies = self.p.batch_function(['count', [2]])
+        self.assertEqual(replies, [[[0, 1], None]])
+
+
+class TestExecutor(unittest.TestCase):
+
+    def test_thread_executor(self):
+        p = oi.Program('programd', None, thread_pool_size=2)
+        p.add_command(
+            'where', lambda: threading.current_thread().name, executor='thread')
+        self.assertNotEqual(
+            p.dispatch('where'), threading.current_thread().name)
+
+    def test_process_executor(self):
+        p = oi.Program('programd', None, process_pool_size=1)
+        p.add_command('pow', pow, executor='process')
+        self.assertEqual(p.dispatch('pow', 2, 3), 8)
+        self.assertRaises(Exception, p.dispatch, 'pow', 'a', 'b')
+        p.pools['process'].shutdown()
+
+    def test_bad_executor(self):
+        p = oi.Program('programd', None)
+        self.assertRaises(ValueError, p.add_command, 'x', abs, executor='gpu')
+
+    def test_executor_needs_service_workers(self):
+        p = oi.Program('programd', 'ipc:///tmp/test-executor.sock')
+        self.assertRaises(
+            ValueError, p.add_command, 'x', abs, executor='thread')
+        p.close()
+
+
+class TestDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.p = oi.Program('programd', None, thread_pool_size=1)
+        self.p.add_command('left', self.p.remaining)
+        self.p.add_command('pooled', self.p.remaining, executor='thread')
+
+    def test_no_deadline(self):
+        self.assertIsNone(self.p.dispatch('left'))
+
+    def test_remaining(self):
+        with context.request(time.time() + 10):
+            self.assertGreater(self.p.dispatch('left'), 9)
+            self.assertGreater(self.p.dispatch('pooled'), 9)
+
+    def test_shed_expired(self):
+        with context.request(time.time() - 1):
+            self.assertRaises(
+                context.DeadlineExceeded, self.p.dispatch, 'left')
+            replies = self.p.batch_function(['left', []], ['ping', []])
+        self.assertEqual(replies[1], [None, 'deadline exceeded'])
+
+        stats = json.loads(self.p.dispatch('stats', 'json'))
+        self.assertEqual(stats['left']['shed'], 2)
+        self.assertEqual(stats['left']['calls'], 0)
+
+    def test_stop_waiting_for_pool(self):
+        self.p.add_command('sleep', time.sleep, executor='thread')
+        with context.request(time.time() + 0.1):
+            start = time.time()
+            self.assertRaises(
+                context.DeadlineExceeded, self.p.dispatch, 'sleep', 0.3)
+            self.assertLess(time.time() - start, 0.25)
+
+        stats = json.loads(self.p.dispatch('stats', 'json'))['sleep']
+        self.assertEqual(
+            (stats['shed'], stats['calls'], stats['errors'],
+             stats['in_flight']), (1, 0, 0, 0))
+
+
+class TestAdmission(unittest.TestCase):
+
+    def test_max_concurrency(self):
+        p = oi.Program('programd', None, service_workers=1)
+        started, release = threading.Event(), threading.Event()
+
+        def heavy():
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        p.add_command('heavy', heavy, max_concurrency=1)
+        t = threading.Thread(target=p.dispatch, args=('heavy',))
+        t.start()
+        started.wait(5)
+        try:
+            self.assertRaises(oi.admission.Busy, p.dispatch, 'heavy')
+            self.assertEqual(p.dispatch('ping'), 'pong')
+        finally:
+            release.set()
+            t.join()
+        self.assertEqual(p.dispatch('heavy'), 'done')
+
+        stats = json.loads(p.dispatch('stats', 'json'))['heavy']
+        self.assertEqual((stats['calls'], stats['busy']), (2, 1))
+
+    def test_max_queue(self):
+        p = oi.Program('programd', None, thread_pool_size=1, max_queue=0)
+        release = threading.Event()
+        p.add_command('wait', lambda: release.wait(5), executor='thread')
+
+        t = threading.Thread(target=p.dispatch, args=('wait',))
+        t.start()
+        time.sleep(0.05)
+        try:
+            replies = p.batch_function(['wait', []])
+            self.assertTrue(oi.admission.is_busy(replies[0][1]))
+        finally:
+            release.set()
+            t.join()
+
+        stats = json.loads(p.dispatch('stats', 'json'))['wait']
+        self.assertEqual((stats['calls'], stats['errors'], stats['busy']),
+                         (1, 0, 1))
+
+    def test_client_retries_busy(self):
+        replies = [(None, 'busy: full'), ('pong', None)]
+
+        class BusyClient(object):
+            def call(self, command, *args):
+                return replies.pop(0)
+
+        w = oi.ClientWrapper.__new__(oi.ClientWrapper)
+        w.timeout, w.c = 3000, BusyClient()
+        w.retry = oi.admission.RetryPolicy(3, 0.001)
+        self.assertEqual(w.call('ping'), ('pong', None))
+
+
+class TestDirect(unittest.TestCase):
+
+    def setUp(self):
+        self.address = 'ipc:///tmp/test-direct.sock'
+        self.p = oi.Program('programd', self.address)
+        self.p.add_command('fail', lambda: 1 / 0)
+        self.p.add_command('left', self.p.remaining)
+        self.p.add_command('count', lambda n: iter(range(int(n))))
+        self.p.add_command('same', lambda obj: obj)
+        self.ctl = oi.CtlProgram('programctl', self.address, direct=True)
+
+    def tearDown(self):
+        self.p.service.socket.close()
+        self.ctl.client.close()
+
+    def test_calls_directly(self):
+        self.assertIsInstance(self.ctl.client, oi.DirectClientWrapper)
+        response = self.ctl.call('ping')
+        self.assertEqual(response.kind, 'remote')
+        self.assertEqual(response.res, 'pong')
+        self.assertIsNone(response.err)
+
+    def test_no_copies(self):
+        obj = object()
+        self.assertIs(self.ctl.client.call('same', obj)[0], obj)
+
+    def test_error(self):
+        response = self.ctl.call('fail')
+        self.assertIsNone(response.res)
+        self.assertIn('division', response.err)
+
+    def test_deadline(self):
+        self.assertGreater(self.ctl.client.call('left')[0], 2)
+
+    def test_stream_and_batch(self):
+        self.assertEqual(list(self.ctl.call('count', '3').res), [0, 1, 2])
+        replies = self.ctl.call_many([('ping', []), ('fail', [])])
+        self.assertEqual(replies[0].res, 'pong')
+        self.assertIsNotNone(replies[1].err)
+
+    def test_falls_back_to_socket(self):
+        ctl = oi.CtlProgram(
+            'programctl', 'ipc:///tmp/test-none.sock', direct=True)
+        self.assertNotIsInstance(ctl.client, oi.DirectClientWrapper)
+        ctl.client.close()
+
+
 class TestState(unittest.TestCase):
 
     def setUp(self):
@@ -58,3 +507,94 @@ class TestState(unittest.TestCase):
     def test_set_get(self):
         self.state.hello = 'world'
         self.assertEqual(self.state.hello, 'world')
+
+    def test_item_and_bulk_writes(self):
+        self.state['a'] = 1
+        self.state.update(b=2, c=3)
+        del self.state.c
+        self.assertEqual(self.state.snapshot(), {'a': 1, 'b': 2})
+        self.assertRaises(AttributeError, getattr, self.state, 'c')
+
+    def test_own_lock(self):
+        self.assertIsNot(self.state._locks[0], oi.State()._locks[0])
+
+    def test_pickle(self):
+        self.state.hello = 'world'
+        copy = pickle.loads(pickle.dumps(self.state))
+        self.assertIsInstance(copy, oi.State)
+        self.assertEqual(copy.hello, 'world')
+
+    def test_changes_since(self):
+        self.state.a = 1
+        self.state.b = 2
+        version = self.state.changes_since(0)['version']
+        self.assertEqual(version, 2)
+
+        self.state.a = 3
+        del self.state.b
+        changes = self.state.changes_since(version)
+        self.assertEqual(changes['changed'], {'a': 3})
+        self.assertEqual(changes['deleted'], ['b'])
+        self.assertFalse(changes['full'])
+        self.assertEqual(self.state.changes_since(changes['version'])['changed'], {})
+
+    def test_changes_since_truncated_log(self):
+        class SmallLogState(oi.State):
+            changelog_size = 2
+
+        state = SmallLogState()
+        for i in range(5):
+            state[str(i)] = i
+        changes = state.changes_since(1)
+        self.assertTrue(changes['full'])
+        self.assertEqual(len(changes['changed']), 5)
+        self.assertFalse(state.changes_since(3)['full'])
+
+    def test_changes_since_truncated_update(self):
+        class SmallLogState(oi.State):
+            changelog_size = 5
+
+        state = SmallLogState()
+        state.a = 1
+        state.update(('k{}'.format(i), i) for i in range(10))
+        changes = state.changes_since(1)
+        self.assertTrue(changes['full'])
+        self.assertEqual(len(changes['changed']), 11)
+
+    def test_changes_since_other_epoch(self):
+        self.state.a = 1
+        self.assertTrue(self.state.changes_since(5)['full'])
+        epoch = self.state.changes_since(0)['epoch']
+        self.assertFalse(self.state.changes_since(1, epoch)['full'])
+        changes = oi.State(a=1).changes_since(0, epoch)
+        self.assertTrue(changes['full'])
+        self.assertEqual(changes['changed'], {'a': 1})
+
+    def test_in_place_union(self):
+        changes = []
+        self.state.subscribe(lambda op, *args: changes.append(op))
+        state = self.state
+        state |= {'a': 1}
+        self.assertIs(state, self.state)
+        self.assertEqual(self.state.a, 1)
+        self.assertEqual(self.state.changes_since(0)['version'], 1)
+        self.assertEqual(changes, ['update'])
+
+    def test_changes_since_clear(self):
+        self.state.a = 1
+        self.state.clear()
+        changes = self.state.changes_since(1)
+        self.assertTrue(changes['full'])
+        self.assertEqual(changes['changed'], {})
+
+    def test_concurrent_writes(self):
+        state = oi.StripedState()
+
+        def work(n):
+            for i in range(1000):
+                state['{}-{}'.format(n, i)] = i
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(len(state), 4000)
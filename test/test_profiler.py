@@ -0,0 +1,56 @@
+import time
+import threading
+import unittest
+
+import oi
+from oi import profiler
+
+
+def spin(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_samples_other_threads(self):
+        p = profiler.Profiler(0.001)
+        self.assertIn('no samples', p.top())
+        p.start()
+        t = threading.Thread(target=spin, args=(0.2,), name='spinner')
+        t.start()
+        t.join()
+        self.assertIn('samples', p.stop())
+
+        top = p.top(5)
+        self.assertIn('spin', top)
+        self.assertIn('spinner', top)
+        self.assertIn('(stopped)', top)
+        self.assertLessEqual(len(top.splitlines()), 7)
+
+
+class TestMemoryTracker(unittest.TestCase):
+
+    def test_diff(self):
+        m = profiler.MemoryTracker()
+        self.assertIn('tracing', m.top())
+        data = [bytearray(1024) for _ in range(100)]
+        try:
+            self.assertIn('test_profiler.py', m.top(5))
+        finally:
+            self.assertEqual(m.stop(), 'stopped tracing')
+        self.assertEqual(len(data), 100)
+
+
+class TestProfilingCommands(unittest.TestCase):
+
+    def test_opt_in(self):
+        self.assertNotIn('profile', oi.Program('programd', None).registered)
+
+        p = oi.Program('programd', None, profiling=True)
+        self.assertIn('profiling every 2ms', p.dispatch('profile', 'start', '2'))
+        time.sleep(0.05)
+        self.assertIn('samples', p.dispatch('profile', 'top', '3'))
+        self.assertIn('samples', p.dispatch('profile', 'stop'))
+        self.assertRaises(Exception, p.dispatch, 'profile', 'bogus')
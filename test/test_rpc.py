@@ -0,0 +1,104 @@
+import time
+import unittest
+
+from oi import context
+from oi import admission
+from oi import rpc
+from oi import codec
+from oi import tracing
+
+
+def new_service(methods):
+    service = rpc.Service.__new__(rpc.Service)
+    service.encoder = codec.WireEncoder(reply_in_kind=True)
+    service.authenticator, service.methods = None, methods
+    return service
+
+
+class TestEnvelope(unittest.TestCase):
+
+    def test_payload_carries_deadline(self):
+        client = rpc.Client.__new__(rpc.Client)
+        client.timeout = 2000
+        method, args, ref, meta = client.build_payload('ping', ())
+        self.assertEqual(method, 'ping')
+        self.assertAlmostEqual(meta['deadline'], time.time() + 2, delta=0.5)
+
+    def test_check_reply(self):
+        client = rpc.Client.__new__(rpc.Client)
+        client.encoder = codec.WireEncoder()
+        payload = ('ping', [], 'ref', {})
+        client.check_reply(payload, {'ref': 'ref', 'result': 'pong'})
+        self.assertRaises(
+            AssertionError, client.check_reply, payload, {'ref': 'other'})
+        self.assertRaises(Exception, client.check_reply, payload, 'garbage')
+
+    def test_service_runs_in_context(self):
+        service = new_service({'left': context.remaining})
+        deadline = time.time() + 5
+
+        args = service.parse(('left', [], 'ref', {'deadline': deadline}))
+        self.assertGreater(service.execute(*args)['result'], 4)
+        self.assertIsNone(context.deadline())
+
+    def test_refusals_are_not_errors(self):
+        def busy():
+            raise admission.Busy('full')
+
+        service = new_service({'busy': busy, 'fail': lambda: 1 / 0})
+        with self.assertLogs(level='DEBUG') as logs:
+            self.assertEqual(
+                service.execute('busy', [], 'ref')['error'], 'busy: full')
+            self.assertIn('division', service.execute('fail', [], 'r')['error'])
+        self.assertEqual(
+            [r.levelname for r in logs.records], ['DEBUG', 'ERROR'])
+
+    def test_old_requests(self):
+        service = new_service({'left': context.remaining})
+        args = service.parse(('left', [], 'ref'))
+        self.assertIsNone(service.execute(*args)['result'])
+
+
+class FakeSocket(object):
+
+    def __init__(self, request):
+        self.request, self.replies = request, []
+
+    def recv(self):
+        return self.request
+
+    def send(self, data):
+        self.replies.append(data)
+
+
+class TestServiceTracing(unittest.TestCase):
+
+    def test_spans(self):
+        service = new_service({'ping': lambda: 'pong'})
+        service.tracer = tracing.Tracer()
+
+        client = rpc.Client.__new__(rpc.Client)
+        client.timeout = 1000
+        payload = client.build_payload('ping', ())
+        service.socket = FakeSocket(service.encoder.encode(payload))
+        service.process()
+
+        record = service.tracer.records[-1]
+        self.assertEqual((record['id'], record['side']), (payload[2], 'service'))
+        self.assertEqual(
+            sorted(record['spans']), ['decode', 'handler', 'queue', 'reply'])
+        reply = service.encoder.decode(service.socket.replies[0])
+        self.assertEqual(reply['result'], 'pong')
+
+    def test_compressed_reply(self):
+        service = new_service({'dump': lambda: 'line\n' * 100000})
+        client = rpc.Client.__new__(rpc.Client)
+        client.timeout, client.compress = 1000, 'zlib'
+        payload = client.build_payload('dump', ())
+        service.socket = FakeSocket(service.encoder.encode(payload))
+        service.process()
+
+        reply = service.socket.replies[0]
+        self.assertTrue(reply.startswith(b'Z'))
+        self.assertEqual(
+            codec.WireEncoder().decode(reply)['result'], 'line\n' * 100000)
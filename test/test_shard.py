@@ -0,0 +1,115 @@
+import unittest
+
+import oi
+from oi.shard import HashRing, ShardedClientWrapper
+
+
+class DirectClient(object):
+
+    def __init__(self, program):
+        self.program = program
+        self.socket = self
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def call(self, command, *args):
+        try:
+            return self.program.handle(command, *args), None
+        except Exception as e:
+            return None, str(e)
+
+
+class LocalShards(ShardedClientWrapper):
+    """ Shards served by in-process programs """
+
+    def new_client(self, addr, timeout):
+        p = oi.Program(addr, None)
+        p.add_command('store', lambda k, v: p.state.__setitem__(k, v))
+        p.add_command('get', lambda k: p.state.get(k))
+        p.add_command('keys', lambda: sorted(p.state))
+        p.add_command('scan', lambda k, n: iter(range(n)))
+        return DirectClient(p)
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = [ring.node('key{}'.format(i)) for i in range(3000)]
+        for node in 'abc':
+            self.assertGreater(owners.count(node), 600)
+
+    def test_minimal_movement(self):
+        ring = HashRing(['a', 'b', 'c'])
+        keys = ['key{}'.format(i) for i in range(3000)]
+        before = dict((k, ring.node(k)) for k in keys)
+        ring.add('d')
+        moved = [k for k in keys if ring.node(k) != before[k]]
+        self.assertTrue(all(ring.node(k) == 'd' for k in moved))
+        self.assertLess(len(moved), 1200)
+
+        ring.remove('d')
+        self.assertEqual(dict((k, ring.node(k)) for k in keys), before)
+
+
+class TestShardedClientWrapper(unittest.TestCase):
+
+    def setUp(self):
+        self.w = LocalShards('s1,s2,s3', 3000)
+
+    def test_routes_to_one_shard(self):
+        for i in range(30):
+            self.w.call('store', 'k{}'.format(i), i)
+        self.assertEqual(self.w.call('get', 'k7'), (7, None))
+
+        keys, errors = self.w.call('keys')
+        self.assertEqual(sum(len(k) for k in keys.values()), 30)
+        self.assertTrue(all(keys.values()))
+
+    def test_global_commands_broadcast(self):
+        self.assertTrue(self.w.is_broadcast('ping'))
+        self.assertTrue(self.w.is_broadcast('keys'))
+        self.assertFalse(self.w.is_broadcast('get', 'a'))
+        self.assertTrue(self.w.is_broadcast('trace', '5'))
+        self.assertTrue(self.w.is_broadcast('profile', 'start'))
+        self.assertTrue(self.w.is_broadcast('memtop', '10'))
+        res, err = self.w.call('ping')
+        self.assertEqual(res, {'s1': 'pong', 's2': 'pong', 's3': 'pong'})
+
+    def test_call_many_keeps_order(self):
+        calls = [('store', ['k{}'.format(i), i]) for i in range(10)]
+        self.w.call_many(calls)
+        replies = self.w.call_many(
+            [('get', ['k{}'.format(i)]) for i in range(10)] + [('ping', [])])
+        self.assertEqual(replies[:10], [(i, None) for i in range(10)])
+        self.assertEqual(replies[10][0]['s2'], 'pong')
+
+    def test_resize(self):
+        self.w.add_shard('s4')
+        self.assertIn('s4', self.w.c)
+        self.w.remove_shard('s4')
+        self.assertEqual(self.w.ring.nodes(), ['s1', 's2', 's3'])
+
+    def test_resize_leaves_calls_in_flight_alone(self):
+        clients, ring = self.w.c, self.w.ring
+        client = self.w._reserve('s2')
+        self.w.add_shard('s4')
+        self.w.remove_shard('s2')
+        self.assertEqual(sorted(clients), ['s1', 's2', 's3'])
+        self.assertEqual(ring.nodes(), ['s1', 's2', 's3'])
+        self.assertFalse(client.closed)
+        self.w._release('s2', client)
+        self.assertTrue(client.closed)
+
+    def test_iter_call_reserves_client(self):
+        addr = self.w.route('scan', 'k', 5)
+        res, err = self.w.iter_call('scan', 'k', 5)
+        client = self.w.c[addr]
+        self.assertIn(client, self.w._in_use)
+        self.w.remove_shard(addr)
+        self.assertFalse(client.closed)
+        self.assertEqual(list(res), [0, 1, 2, 3, 4])
+        self.assertNotIn(client, self.w._in_use)
+        self.assertTrue(client.closed)
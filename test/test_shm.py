@@ -0,0 +1,83 @@
+import unittest
+import multiprocessing
+
+from oi import shm
+
+
+def read_in_child(view, key, queue):
+    queue.put((view[key], len(view), sorted(view.keys())))
+
+
+class TestSharedState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = shm.SharedState(size=4096, slots=64)
+        self.view = shm.attach(self.state.shm_name)
+
+    def tearDown(self):
+        self.view.close()
+        self.state.close()
+
+    def test_mirror(self):
+        self.state.a = {'x': [1, 2]}
+        self.state.update(b=2, c=3)
+        del self.state.c
+        self.assertEqual(self.view['a'], {'x': [1, 2]})
+        self.assertEqual(self.view.b, 2)
+        self.assertNotIn('c', self.view)
+        self.assertEqual(len(self.view), 2)
+
+        self.state.clear()
+        self.assertEqual(self.view.keys(), [])
+
+    def test_overwrite_and_compact(self):
+        for i in range(500):
+            self.state['key'] = 'x' * 50 + str(i)
+        self.assertEqual(self.view['key'], 'x' * 50 + '499')
+
+    def test_string_keys_only(self):
+        self.assertRaises(TypeError, self.state.__setitem__, 1, 'a')
+        self.assertNotIn(1, self.state)
+
+    def test_unpicklable_value_stays_local(self):
+        self.state.f = lambda: None
+        self.assertTrue(callable(self.state.f))
+        self.assertNotIn('f', self.view)
+
+    def test_full_segment_stays_local(self):
+        self.state.big = 'x' * 5000
+        self.assertEqual(len(self.state.big), 5000)
+        self.assertNotIn('big', self.view)
+        self.assertEqual(self.state.changes_since(0)['version'], 1)
+
+        state = shm.SharedState(size=4096, slots=2)
+        try:
+            state.update(a=1, b=2, c=3)
+            self.assertEqual(len(state), 3)
+            self.assertEqual(state.changes_since(0)['version'], 1)
+            view = shm.attach(state.shm_name)
+            self.assertEqual(len(view), 2)
+            view.close()
+        finally:
+            state.close()
+
+    def test_stuck_write(self):
+        self.state.a = 1
+        self.view.segment.read_timeout = 0.05
+        self.state._segment._bump()
+        self.assertRaises(RuntimeError, self.view.get, 'a')
+        self.state._segment._bump()
+        self.assertEqual(self.view.a, 1)
+
+    def test_copy(self):
+        self.state.a = 1
+        self.assertEqual(self.state.copy(), {'a': 1})
+
+    def test_child_process_reads(self):
+        self.state.a = 'shared'
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(
+            target=read_in_child, args=(self.state, 'a', queue))
+        p.start()
+        p.join()
+        self.assertEqual(queue.get(timeout=5), ('shared', 1, ['a']))
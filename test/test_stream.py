@@ -0,0 +1,44 @@
+import unittest
+
+from oi import stream
+
+
+class TestStreams(unittest.TestCase):
+
+    def test_chunks(self):
+        streams = stream.Streams(chunk_size=2)
+        chunk = streams.start(iter(range(5)))
+        sid = chunk[stream.MARKER]
+        self.assertEqual((chunk['items'], chunk['more']), ([0, 1], True))
+        self.assertEqual(streams.next(sid)['items'], [2, 3])
+        chunk = streams.next(sid)
+        self.assertEqual((chunk['items'], chunk['more']), ([4], False))
+        self.assertNotIn(sid, streams.open)
+
+    def test_close_early(self):
+        closed = []
+
+        def gen():
+            try:
+                for i in range(10):
+                    yield i
+            finally:
+                closed.append(True)
+
+        streams = stream.Streams(chunk_size=2)
+        sid = streams.start(gen())[stream.MARKER]
+        streams.close(sid)
+        self.assertEqual(closed, [True])
+        self.assertRaises(Exception, streams.next, sid)
+
+    def test_purge_idle(self):
+        streams = stream.Streams(chunk_size=1, idle_timeout=-1)
+        streams.start(iter(range(5)))
+        streams.purge()
+        self.assertEqual(streams.open, {})
+
+    def test_is_iterator(self):
+        self.assertTrue(stream.is_iterator(x for x in []))
+        self.assertFalse(stream.is_iterator([]))
+        self.assertFalse(stream.is_iterator({}))
+        self.assertFalse(stream.is_iterator('abc'))
@@ -0,0 +1,50 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from oi import tracing
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'requests.trace')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record(self):
+        t = tracing.Tracer(size=2)
+        t.record('a', 'service', 'ping', [None, 10.0, 10.001, 10.002, 10.003])
+        t.record('b', 'service', 'slow', [9.9, 10.0, 10.0, 10.5, 10.5], 'oops')
+        t.record('c', 'client', 'slow', [9.8, 9.9, 9.9, 10.6, 10.6])
+
+        self.assertEqual([r['id'] for r in t.records], ['b', 'c'])
+        slowest = t.slowest(1, 'service')[0]
+        self.assertEqual(slowest['ms'], 600)
+        self.assertEqual(slowest['spans']['handler'], 500)
+        self.assertTrue(slowest['error'])
+
+        text = t.to_text()
+        self.assertIn('slow (err)', text)
+        self.assertIn('handler', text.splitlines()[0])
+
+    def test_flush(self):
+        t = tracing.Tracer(self.path, flush_every=2)
+        times = [1.0, 1.1, 1.2, 1.3, 1.4]
+        t.record('a', 'client', 'ping', times)
+        self.assertFalse(os.path.exists(self.path))
+        t.record('b', 'client', 'ping', times)
+        t.record('c', 'client', 'ping', times)
+        t.flush()
+
+        with open(self.path) as fh:
+            records = [json.loads(line) for line in fh]
+        self.assertEqual([r['id'] for r in records], ['a', 'b', 'c'])
+        self.assertEqual(sorted(records[0]['spans']), sorted(tracing.SPANS['client']))
+
+    def test_empty(self):
+        self.assertEqual(tracing.Tracer().to_text(), 'no requests traced')
@@ -17,3 +17,31 @@ def test_qsplit():
 
     for text, expected in tests:
         yield check, util.split(text), expected
+
+
+def test_split_commands():
+    tests = [
+        ('ping', ['ping']),
+        ('get a; get b', ['get a', ' get b']),
+        ('store a "x;y"; ping;', ['store a "x;y"', ' ping']),
+    ]
+
+    def check(a, b):
+        assert a == b
+
+    for text, expected in tests:
+        yield check, util.split_commands(text), expected
+
+
+def test_group_commands():
+    tests = [
+        (['ping'], [('ping', [])]),
+        (['get', 'a;', 'get', 'b'], [('get', ['a']), ('get', ['b'])]),
+        (['get', 'a', ';', 'ping', ';'], [('get', ['a']), ('ping', [])]),
+    ]
+
+    def check(a, b):
+        assert a == b
+
+    for parts, expected in tests:
+        yield check, util.group_commands(parts), expected